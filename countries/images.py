@@ -0,0 +1,514 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from xml.sax.saxutils import escape, quoteattr
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+from django.conf import settings
+from PIL import Image, ImageDraw, ImageFont, features
+
+from .metrics import registry as metrics
+from .timing import timed_cache as cache
+
+SUMMARY_IMAGE_KEY = 'countries:summary_image'
+IMAGES_DIR_NAME = 'images'
+RENDER_LOCK_NAME = '.summary.lock'
+RENDER_TMP_PREFIX = '.render-'
+MANIFEST_NAME = 'manifest.json'
+VERSIONS_KEPT = 3
+DIGEST_RE = re.compile(r'[0-9a-f]{32}')
+
+# Output format -> (content type, Pillow save options), in order of preference
+IMAGE_FORMATS = {
+    'avif': ('image/avif', {'quality': 60, 'speed': 8}),
+    'webp': ('image/webp', {'quality': 80, 'method': 4}),
+    'png': ('image/png', {'optimize': True}),
+    'svg': ('image/svg+xml', None),
+}
+VECTOR_FORMATS = ('svg',)
+DEFAULT_FORMAT = 'png'
+PNG_COLORS = 64
+# Size name -> divisor applied to the 2x render
+IMAGE_SIZES = {'thumb': 8, '1x': 2, '2x': 1}
+DEFAULT_SIZE = '1x'
+
+_render_lock = threading.Lock()
+
+
+def images_root():
+    return os.path.join(settings.CACHE_DIR, IMAGES_DIR_NAME)
+
+
+def available_formats():
+    """Formats this Pillow build can encode (AVIF needs libavif)"""
+    return [fmt for fmt in IMAGE_FORMATS if fmt in ('png', 'svg') or features.check(fmt)]
+
+
+def region_slug(region):
+    return re.sub(r'[^a-z0-9]+', '-', region.lower()).strip('-')
+
+
+def variant_name(size, fmt, region=None):
+    """File name of one rendered variant; region is a slug, None for the global summary"""
+    if region:
+        return f'summary-{region}-{size}.{fmt}'
+    return f'summary-{size}.{fmt}'
+
+
+class SummaryLayout:
+    """Positioned text on a plain background, in 1x pixels, independent of output format
+
+    Items marked static (titles, headings) do not depend on the data, so the
+    raster renderer draws them once into a reusable template.
+    """
+
+    FONT_SIZES = {'title': 24, 'heading': 18, 'body': 14, 'small': 10}
+
+    def __init__(self, width, height, background='white', color='black'):
+        self.width = width
+        self.height = height
+        self.background = background
+        self.color = color
+        self.static_items = []
+        self.items = []
+
+    def text(self, x, y, text, style='body', static=False):
+        (self.static_items if static else self.items).append(('text', x, y, text, style))
+
+    def rect(self, x, y, width, height, fill):
+        self.items.append(('rect', x, y, width, height, fill))
+
+    def bar_chart(self, x, y, width, title, entries, fill='#4a7bd0', label_width=190, row_height=30):
+        """Horizontal bars for [(label, value, value_text)]; returns the y below the chart"""
+        self.text(x, y, title, 'heading', static=True)
+        y += row_height
+        largest = max((value for _, value, _ in entries), default=0) or 1
+        bar_x = x + label_width
+        bar_space = width - label_width - 90
+        for label, value, value_text in entries:
+            if len(label) > 24:
+                label = label[:23] + '\u2026'
+            self.text(x, y, label, 'body')
+            bar_width = max(1, round(bar_space * value / largest))
+            self.rect(bar_x, y, bar_width, row_height - 10, fill)
+            self.text(bar_x + bar_width + 8, y, value_text, 'body')
+            y += row_height
+        return y
+
+    @classmethod
+    def error(cls, message):
+        layout = cls(400, 200, background='red', color='white')
+        layout.text(50, 80, message, 'small', static=True)
+        return layout
+
+
+class RasterRenderer:
+    """Pillow renderer that keeps fonts and static templates for the life of the process
+
+    Fonts come from SUMMARY_FONT_PATH when set, otherwise from the font
+    embedded in Pillow, so output does not depend on system fonts. With
+    cached=False fonts and templates are rebuilt on every render, as the
+    renderer used to, which is what the benchmark_images command compares.
+    """
+
+    MAX_TEMPLATES = 32
+
+    def __init__(self, font_path=None, cached=True):
+        self.font_path = font_path
+        self.cached = cached
+        self._fonts = {}
+        self._templates = {}
+        self._lock = threading.Lock()
+
+    def font(self, size):
+        font = self._fonts.get(size)
+        if font is None:
+            if self.font_path:
+                font = ImageFont.truetype(self.font_path, size)
+            else:
+                font = ImageFont.load_default(size)
+            self._fonts[size] = font
+        return font
+
+    def draw_items(self, image, layout, items, scale):
+        draw = ImageDraw.Draw(image)
+        for kind, x, y, *rest in items:
+            if kind == 'rect':
+                width, height, fill = rest
+                draw.rectangle(
+                    [x * scale, y * scale, (x + width) * scale - 1, (y + height) * scale - 1], fill=fill
+                )
+            else:
+                text, style = rest
+                draw.text(
+                    (x * scale, y * scale), text, fill=layout.color,
+                    font=self.font(layout.FONT_SIZES[style] * scale),
+                )
+
+    def template(self, layout, scale):
+        """Background with the static items drawn, shared by every layout that has them"""
+        key = (layout.width, layout.height, layout.background, layout.color,
+               tuple(layout.static_items), scale)
+        with self._lock:
+            image = self._templates.get(key)
+            if image is None:
+                image = Image.new('RGB', (layout.width * scale, layout.height * scale), color=layout.background)
+                self.draw_items(image, layout, layout.static_items, scale)
+                if len(self._templates) >= self.MAX_TEMPLATES:
+                    self._templates.clear()
+                self._templates[key] = image
+            return image
+
+    def render(self, layout, scale=1):
+        """Draw a layout at scale times its 1x size"""
+        if not self.cached:
+            self._fonts = {}
+            self._templates = {}
+        image = self.template(layout, scale).copy()
+        self.draw_items(image, layout, layout.items, scale)
+        return image
+
+
+_raster_renderer = None
+
+
+def get_raster_renderer():
+    global _raster_renderer
+    if _raster_renderer is None:
+        _raster_renderer = RasterRenderer(getattr(settings, 'SUMMARY_FONT_PATH', None))
+    return _raster_renderer
+
+
+def rasterize(layout, scale=1):
+    """Draw a layout with the process-wide Pillow renderer"""
+    return get_raster_renderer().render(layout, scale)
+
+
+def render_svg(layout, width=None):
+    """Serialize a layout as SVG text; width rescales it through the viewBox"""
+    width = width or layout.width
+    height = round(layout.height * width / layout.width)
+    parts = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" '
+        f'viewBox="0 0 {layout.width} {layout.height}" font-family="Arial, Helvetica, sans-serif">',
+        f'<rect width="100%" height="100%" fill={quoteattr(layout.background)}/>',
+    ]
+    for kind, x, y, *rest in layout.static_items + layout.items:
+        if kind == 'rect':
+            width, height, fill = rest
+            parts.append(f'<rect x="{x}" y="{y}" width="{width}" height="{height}" fill={quoteattr(fill)}/>')
+        else:
+            text, style = rest
+            parts.append(
+                f'<text x="{x}" y="{y}" font-size="{layout.FONT_SIZES[style]}" '
+                f'dominant-baseline="text-before-edge" fill={quoteattr(layout.color)}>{escape(text)}</text>'
+            )
+    parts.append('</svg>')
+    return '\n'.join(parts)
+
+
+def publish_summary_image(version, digest):
+    """Tell every worker which image set is current and which dataset version produced it"""
+    cache.set(SUMMARY_IMAGE_KEY, {'version': version, 'digest': digest}, None)
+    summary_image_cache.forget_published()
+
+
+def layout_digest(layouts):
+    """Hash of exactly what would be drawn, plus the settings that shape the output files"""
+    payload = {
+        'layouts': [
+            [region or '', layout.width, layout.height, layout.background, layout.color,
+             layout.static_items, layout.items]
+            for region, layout in sorted(layouts.items(), key=lambda item: item[0] or '')
+        ],
+        'formats': available_formats(),
+        'encoders': {fmt: options for fmt, (_, options) in IMAGE_FORMATS.items()},
+        'sizes': IMAGE_SIZES,
+        'png_colors': PNG_COLORS,
+        'font': getattr(settings, 'SUMMARY_FONT_PATH', None),
+    }
+    encoded = json.dumps(payload, sort_keys=True, default=str).encode()
+    return hashlib.blake2b(encoded, digest_size=16).hexdigest()
+
+
+@contextmanager
+def render_lock():
+    """Exclusive across threads and, where flock exists, across worker processes"""
+    os.makedirs(images_root(), exist_ok=True)
+    with _render_lock:
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(settings.CACHE_DIR, RENDER_LOCK_NAME), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def write_variants(directory, layout, region=None):
+    """Encode every size and format of a layout into directory; returns {name: bytes}
+
+    Runs in pool worker processes, so it only touches Pillow and the filesystem.
+    """
+    full = rasterize(layout, scale=2)
+    formats = available_formats()
+    variants = {}
+    for size, divisor in IMAGE_SIZES.items():
+        image = full if divisor == 1 else full.resize(
+            (full.width // divisor, full.height // divisor), Image.LANCZOS
+        )
+        for fmt in formats:
+            name = variant_name(size, fmt, region)
+            if fmt in VECTOR_FORMATS:
+                with open(os.path.join(directory, name), 'w', encoding='utf-8') as f:
+                    f.write(render_svg(layout, width=image.width))
+                variants[name] = os.path.getsize(os.path.join(directory, name))
+                continue
+            # Black text on white needs few colours; a palette keeps PNG near WebP size
+            encoded = image.quantize(PNG_COLORS) if fmt == 'png' else image
+            encoded.save(os.path.join(directory, name), format=fmt.upper(), **IMAGE_FORMATS[fmt][1])
+            variants[name] = os.path.getsize(os.path.join(directory, name))
+    return variants
+
+
+def warm_raster_renderer(scale):
+    """Pool initializer: build the worker's renderer and load every font size up front"""
+    renderer = get_raster_renderer()
+    for size in SummaryLayout.FONT_SIZES.values():
+        renderer.font(size * scale)
+
+
+_render_pool = None
+_render_pool_lock = threading.Lock()
+# Only long-running non-web processes opt in; see enable_render_pool
+_render_pool_enabled = False
+
+
+def enable_render_pool():
+    """Let this process render through a persistent pool
+
+    Called by the scheduler and management commands. Web workers never
+    enable it: forking from a threaded gunicorn worker is unsafe and idle
+    pool processes would sit beside every worker, so they render in process.
+    """
+    global _render_pool_enabled
+    _render_pool_enabled = True
+
+
+def get_render_pool(workers):
+    """Process pool kept for the life of this process
+
+    Its workers keep their RasterRenderer between refreshes, so fonts and
+    static templates are only built by the first render, not by every one.
+    """
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is None or _render_pool[:2] != (os.getpid(), workers):
+            # A forked process must not reuse its parent's pool
+            # write_variants draws every layout at 2x
+            _render_pool = (os.getpid(), workers, ProcessPoolExecutor(
+                max_workers=workers, initializer=warm_raster_renderer, initargs=(2,),
+            ))
+        return _render_pool[2]
+
+
+def discard_render_pool():
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is not None:
+            _render_pool[2].shutdown(wait=False, cancel_futures=True)
+            _render_pool = None
+
+
+def write_layouts(directory, layouts):
+    """Encode {region or None: layout} into directory, in parallel when workers allow
+
+    Layouts are built up front in this process (they need the database) and
+    only the CPU-bound rasterizing and encoding is farmed out to a long-lived
+    pool in processes that called enable_render_pool. A broken pool (a worker
+    was killed) is replaced on the next render.
+    """
+    regions = {region_slug(region): region for region in layouts if region}
+    jobs = [(region_slug(region) if region else None, layout) for region, layout in layouts.items()]
+    workers = getattr(settings, 'IMAGE_RENDER_WORKERS', 1)
+    if _render_pool_enabled and workers > 1 and len(jobs) > 1:
+        try:
+            results = list(get_render_pool(workers).map(
+                write_variants, [directory] * len(jobs),
+                [layout for _, layout in jobs], [slug for slug, _ in jobs],
+            ))
+        except BrokenProcessPool:
+            discard_render_pool()
+            raise
+    else:
+        results = [write_variants(directory, layout, slug) for slug, layout in jobs]
+
+    variants = {}
+    for result in results:
+        variants.update(result)
+    return {
+        'formats': available_formats(),
+        'sizes': list(IMAGE_SIZES),
+        'regions': regions,
+        'variants': variants,
+    }
+
+
+def prune_versions(keep):
+    """Drop old image sets, keeping the most recently used so in-flight reads still succeed
+
+    Temp directories of renders killed before they could clean up are
+    dropped once they are older than any refresh may run (REFRESH_LOCK_TIMEOUT).
+    """
+    root = images_root()
+    stale_before = time.time() - getattr(settings, 'REFRESH_LOCK_TIMEOUT', 600)
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if name.startswith(RENDER_TMP_PREFIX) and os.path.getmtime(path) < stale_before:
+            shutil.rmtree(path, ignore_errors=True)
+    paths = [os.path.join(root, name) for name in os.listdir(root) if not name.startswith('.')]
+    paths.sort(key=os.path.getmtime)
+    for path in paths[:-keep]:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def render_summary_images(version, build_layouts):
+    """Make the image set for a dataset version current, rendering only if its content is new
+
+    Image sets live in directories named by layout_digest, so a version whose
+    layouts match an existing set just republishes it and clients keep their
+    ETags. Concurrent callers queue on the lock and then find the version
+    already published, so a burst triggers one render. Variants are written
+    to a temp directory renamed into place, so readers never see a partial set.
+    """
+    with render_lock():
+        published = cache.get(SUMMARY_IMAGE_KEY)
+        if published and published['version'] == version and \
+                os.path.isdir(os.path.join(images_root(), published['digest'])):
+            return os.path.join(images_root(), published['digest'])
+        layouts = build_layouts()
+        digest = layout_digest(layouts)
+        directory = os.path.join(images_root(), digest)
+        if os.path.exists(os.path.join(directory, MANIFEST_NAME)):
+            print(f"Summary images unchanged, reusing: {directory}")
+            os.utime(directory)
+            metrics.inc('image_renders_total', result='reused')
+        else:
+            tmp_dir = tempfile.mkdtemp(dir=images_root(), prefix=RENDER_TMP_PREFIX)
+            try:
+                with metrics.time('image_render_duration_seconds'):
+                    manifest = write_layouts(tmp_dir, layouts)
+                with open(os.path.join(tmp_dir, MANIFEST_NAME), 'w') as f:
+                    json.dump(manifest, f)
+                shutil.rmtree(directory, ignore_errors=True)
+                os.replace(tmp_dir, directory)
+            except BaseException:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                raise
+            metrics.inc('image_renders_total', result='rendered')
+            print(f"Images saved to: {directory}")
+        publish_summary_image(version, digest)
+        prune_versions(VERSIONS_KEPT)
+    return directory
+
+
+class SummaryImageCache:
+    """Per-worker copy of rendered summary image variants for the current image set
+
+    Entries are keyed by the set's content digest, which doubles as the ETag
+    prefix, so an unchanged image keeps its ETag across dataset versions.
+    """
+
+    def __init__(self):
+        self.digest = None
+        self.manifest = None
+        self.bodies = {}
+        self.published = None
+        self.checked_at = None
+        self._lock = threading.Lock()
+
+    def forget_published(self):
+        """Re-read the published digest on the next request instead of waiting out the TTL"""
+        self.checked_at = None
+
+    def _published_digest(self):
+        # The shared cache is file-backed, so it is read at most once per TTL
+        ttl = getattr(settings, 'SUMMARY_IMAGE_CHECK_INTERVAL', 2.0)
+        now = time.monotonic()
+        if self.checked_at is None or now - self.checked_at >= ttl:
+            published = cache.get(SUMMARY_IMAGE_KEY)
+            self.published = published['digest'] if published else None
+            self.checked_at = now
+        return self.published
+
+    def _sync(self, digest):
+        if digest == self.digest:
+            return True
+        try:
+            with open(os.path.join(images_root(), digest, MANIFEST_NAME)) as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return False
+        self.digest = digest
+        self.manifest = manifest
+        self.bodies = {}
+        return True
+
+    def locate(self, names):
+        """(digest, name) of the first of names in the current image set, without reading it
+
+        digest is None when no image set is published yet; name is None when
+        the set has none of the variants.
+        """
+        with self._lock:
+            digest = self._published_digest()
+            if digest is None or not self._sync(digest):
+                return None, None
+            for name in names:
+                if name in self.manifest['variants']:
+                    return self.digest, name
+            return self.digest, None
+
+    def read(self, digest, name):
+        """Bytes of a variant in the current image set, kept in memory after the first read"""
+        with self._lock:
+            if digest != self.digest or name not in self.manifest['variants']:
+                return None
+            if name not in self.bodies:
+                try:
+                    with open(os.path.join(images_root(), digest, name), 'rb') as f:
+                        self.bodies[name] = f.read()
+                except FileNotFoundError:
+                    return None
+            return self.bodies[name]
+
+
+summary_image_cache = SummaryImageCache()
+
+
+def image_set_file(digest, name):
+    """Path of a variant in any retained image set, or None if it is unknown or pruned"""
+    if not DIGEST_RE.fullmatch(digest):
+        return None
+    if summary_image_cache.locate([name]) == (digest, name):
+        return os.path.join(images_root(), digest, name)
+    try:
+        with open(os.path.join(images_root(), digest, MANIFEST_NAME)) as f:
+            variants = json.load(f)['variants']
+    except FileNotFoundError:
+        return None
+    return os.path.join(images_root(), digest, name) if name in variants else None
@@ -0,0 +1,26 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from countries.rates import archive_rate_history
+
+
+class Command(BaseCommand):
+    help = 'Archive old exchange rate history to a compressed .npz file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help='Path of the .npz archive to write')
+        parser.add_argument(
+            '--older-than-days', type=int, default=90,
+            help='Archive rows older than this many days (default: 90)',
+        )
+        parser.add_argument(
+            '--delete', action='store_true',
+            help='Delete archived rows from the database afterwards',
+        )
+
+    def handle(self, *args, **options):
+        before = timezone.now() - timedelta(days=options['older_than_days'])
+        total = archive_rate_history(before, options['output'], delete=options['delete'])
+        self.stdout.write(self.style.SUCCESS(f"Archived {total} rate rows to {options['output']}"))
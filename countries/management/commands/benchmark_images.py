@@ -0,0 +1,76 @@
+import io
+import shutil
+import statistics
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from countries.images import (
+    IMAGE_FORMATS, PNG_COLORS, VECTOR_FORMATS, RasterRenderer, available_formats, enable_render_pool, render_svg,
+    write_layouts,
+)
+from countries.utils import build_summary_layouts
+
+
+def time_ms(func, iterations):
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+class Command(BaseCommand):
+    help = 'Time summary image layout, rasterizing (cold vs cached renderer), encoding and a full image set write'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=20, help='Runs per measurement (default: 20)')
+        parser.add_argument('--scale', type=int, default=2, help='Raster scale to render at (default: 2)')
+
+    def report(self, label, samples):
+        self.stdout.write(
+            f"{label:<28} mean {statistics.mean(samples):8.3f} ms   "
+            f"p50 {statistics.median(samples):8.3f} ms   min {min(samples):8.3f} ms"
+        )
+
+    def handle(self, *args, **options):
+        enable_render_pool()
+        iterations = options['iterations']
+        scale = options['scale']
+        font_path = getattr(settings, 'SUMMARY_FONT_PATH', None)
+
+        self.report('build layouts', time_ms(build_summary_layouts, iterations))
+        layouts = list(build_summary_layouts().values())
+        self.stdout.write(f"{len(layouts)} layouts, scale {scale}, {iterations} iterations\n")
+
+        cold = RasterRenderer(font_path, cached=False)
+        warm = RasterRenderer(font_path)
+        warm.render(layouts[0], scale)
+        for label, renderer in (('rasterize (uncached)', cold), ('rasterize (cached)', warm)):
+            self.report(label, time_ms(
+                lambda: [renderer.render(layout, scale) for layout in layouts], iterations
+            ))
+        self.report('render svg', time_ms(lambda: [render_svg(layout) for layout in layouts], iterations))
+
+        image = warm.render(layouts[0], scale)
+        for fmt in available_formats():
+            if fmt in VECTOR_FORMATS:
+                continue
+            encoded = image.quantize(PNG_COLORS) if fmt == 'png' else image
+            self.report(f'encode {fmt} (1 image)', time_ms(
+                lambda: encoded.save(io.BytesIO(), format=fmt.upper(), **IMAGE_FORMATS[fmt][1]), iterations
+            ))
+
+        # The production path: every size and format, through the IMAGE_RENDER_WORKERS pool
+        directory = tempfile.mkdtemp(prefix='benchmark-images-')
+        try:
+            layouts = build_summary_layouts()
+            self.report('write image set (first)', time_ms(lambda: write_layouts(directory, layouts), 1))
+            self.report(f'write image set (workers={settings.IMAGE_RENDER_WORKERS})', time_ms(
+                lambda: write_layouts(directory, layouts), iterations
+            ))
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,131 @@
+import json
+import os
+import random
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from countries.sources import RefreshScope, get_source
+
+COUNTRIES_FILE = 'countries.json'
+RATES_FILE = 'rates.json'
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    """Serves recorded payloads on the restcountries v2 and open.er-api v6 paths"""
+    payloads = {}
+    countries = []
+    latency = 0.0
+    jitter = 0.0
+    failure_rate = 0.0
+
+    def do_GET(self):
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+
+        if self.failure_rate and random.random() < self.failure_rate:
+            return self.send_body(503, b'{"error": "Injected failure"}')
+
+        url = urlsplit(self.path)
+        path = url.path
+        if path == '/v2/all':
+            return self.send_body(200, self.payloads[COUNTRIES_FILE])
+        if path.startswith('/v2/'):
+            return self.send_scoped(path[len('/v2/'):], parse_qs(url.query))
+        if path.startswith('/v6/latest/'):
+            return self.send_body(200, self.payloads[RATES_FILE])
+        return self.send_body(404, b'{"error": "Not found"}')
+
+    def send_scoped(self, endpoint, query):
+        """Mimic the v2 region, name, currency and alpha endpoints"""
+        kind, _, value = endpoint.partition('/')
+        value = unquote(value)
+        scopes = {
+            'region': lambda: RefreshScope(regions=[value]),
+            'name': lambda: RefreshScope(names=[value]),
+            'currency': lambda: RefreshScope(currencies=[value]),
+            'alpha': lambda: RefreshScope(codes=query.get('codes', [''])[0].split(',')),
+        }
+        if kind not in scopes:
+            return self.send_body(404, b'{"status": 404, "message": "Not Found"}')
+        scope = scopes[kind]()
+        matches = [record for record in self.countries if scope.matches(record)]
+        if not matches:
+            return self.send_body(404, b'{"status": 404, "message": "Not Found"}')
+        return self.send_body(200, json.dumps(matches).encode())
+
+    def send_body(self, code, body):
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Command(BaseCommand):
+    help = 'Serve recorded upstream payloads locally for offline refreshes and load tests'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dir', default=os.path.join(settings.BASE_DIR, 'fixtures', 'sources'),
+            help='Directory holding countries.json and rates.json',
+        )
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--latency', type=float, default=0.0, help='Fixed delay per request in ms')
+        parser.add_argument('--jitter', type=float, default=0.0, help='Extra random delay per request in ms')
+        parser.add_argument(
+            '--failure-rate', type=float, default=0.0,
+            help='Fraction of requests answered with 503 (0.0-1.0)',
+        )
+        parser.add_argument(
+            '--record', action='store_true',
+            help='Fetch from the configured sources and save payloads before serving',
+        )
+
+    def handle(self, *args, **options):
+        directory = options['dir']
+        if options['record']:
+            os.makedirs(directory, exist_ok=True)
+            for filename, kind in ((COUNTRIES_FILE, 'countries'), (RATES_FILE, 'rates')):
+                data = get_source(kind).fetch()
+                if kind == 'rates':
+                    data = {'result': 'success', 'base_code': 'USD', 'rates': data}
+                with open(os.path.join(directory, filename), 'w', encoding='utf-8') as f:
+                    json.dump(data, f)
+                self.stdout.write(f'Recorded {filename}')
+
+        payloads = {}
+        for filename in (COUNTRIES_FILE, RATES_FILE):
+            path = os.path.join(directory, filename)
+            if not os.path.exists(path):
+                raise CommandError(f'{path} not found; run with --record first')
+            with open(path, 'rb') as f:
+                payloads[filename] = f.read()
+
+        FixtureHandler.payloads = payloads
+        FixtureHandler.countries = json.loads(payloads[COUNTRIES_FILE])
+        FixtureHandler.latency = options['latency'] / 1000
+        FixtureHandler.jitter = options['jitter'] / 1000
+        FixtureHandler.failure_rate = options['failure_rate']
+
+        server = ThreadingHTTPServer((options['host'], options['port']), FixtureHandler)
+        base = f"http://{options['host']}:{options['port']}"
+        self.stdout.write(self.style.SUCCESS(
+            f'Serving fixtures from {directory}\n'
+            f'  COUNTRIES_SOURCE_LOCATION={base}/v2\n'
+            f'  RATES_SOURCE_LOCATION={base}/v6'
+        ))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
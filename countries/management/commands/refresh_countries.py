@@ -0,0 +1,32 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from countries.images import enable_render_pool
+from countries.sources import RefreshScope
+from countries.utils import refresh_countries_data, RefreshInProgress
+
+
+class Command(BaseCommand):
+    help = 'Refresh countries from the configured source, optionally limited to a subset'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--region', action='append', default=[], help='Only refresh this region (repeatable)')
+        parser.add_argument('--name', action='append', default=[], help='Only refresh this country (repeatable)')
+        parser.add_argument('--currency', action='append', default=[], help='Only refresh countries using this currency code (repeatable)')
+        parser.add_argument('--code', action='append', default=[], help='Only refresh this ISO alpha-2/3 code (repeatable)')
+        parser.add_argument('--dry-run', action='store_true', help='Report what would change without writing')
+
+    def handle(self, *args, **options):
+        enable_render_pool()
+        scope = RefreshScope(
+            regions=options['region'],
+            names=options['name'],
+            currencies=options['currency'],
+            codes=options['code'],
+        )
+        try:
+            result = refresh_countries_data(scope or None, dry_run=options['dry_run'])
+        except RefreshInProgress as e:
+            raise CommandError(str(e))
+        self.stdout.write(json.dumps(result, indent=2))
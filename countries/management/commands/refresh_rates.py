@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from countries.images import enable_render_pool
+from countries.utils import refresh_exchange_rates, RefreshInProgress
+
+
+class Command(BaseCommand):
+    help = 'Refresh exchange rates and recompute estimated GDP without refetching countries'
+
+    def handle(self, *args, **options):
+        enable_render_pool()
+        try:
+            result = refresh_exchange_rates()
+        except RefreshInProgress as e:
+            raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS(
+            f"{result['message']} ({result['countries_updated']} countries updated)"
+        ))
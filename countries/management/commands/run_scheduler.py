@@ -0,0 +1,61 @@
+import signal
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+
+from countries.scheduler import LOCAL_CACHE_BACKENDS, RefreshScheduler, ScheduledJob
+from countries.images import SUMMARY_IMAGE_KEY, enable_render_pool
+from countries.utils import generate_summary_image, refresh_countries_data, refresh_exchange_rates
+
+
+class Command(BaseCommand):
+    help = 'Run countries and exchange rates refreshes on a jittered schedule (leader-elected)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--countries-interval', type=float, default=settings.COUNTRIES_REFRESH_INTERVAL,
+            help='Seconds between full countries refreshes',
+        )
+        parser.add_argument(
+            '--rates-interval', type=float, default=settings.RATES_REFRESH_INTERVAL,
+            help='Seconds between exchange rates refreshes',
+        )
+        parser.add_argument(
+            '--jitter', type=float, default=settings.SCHEDULER_JITTER,
+            help='Fraction of the interval to randomize by (0.1 = +/-10%%)',
+        )
+        parser.add_argument(
+            '--lease-ttl', type=float, default=settings.SCHEDULER_LEASE_TTL,
+            help='Seconds a leader lease lasts without renewal',
+        )
+
+    def handle(self, *args, **options):
+        enable_render_pool()
+        backend = settings.CACHES['default']['BACKEND']
+        if backend in LOCAL_CACHE_BACKENDS:
+            # Dataset versions, published rates and image sets live in this cache and
+            # CACHE_DIR, so web workers on another machine would never see a refresh
+            self.stderr.write(self.style.WARNING(
+                f'{backend} is local to this machine: run the scheduler next to the web '
+                'workers (same container or volume) or configure a shared cache backend'
+            ))
+        jobs = [
+            ScheduledJob('countries', refresh_countries_data, options['countries_interval'],
+                         jitter=options['jitter'], max_backoff=settings.SCHEDULER_MAX_BACKOFF),
+            ScheduledJob('rates', refresh_exchange_rates, options['rates_interval'],
+                         jitter=options['jitter'], max_backoff=settings.SCHEDULER_MAX_BACKOFF),
+        ]
+        if cache.get(SUMMARY_IMAGE_KEY) is None:
+            # Image views answer 503 until a set is published; do not wait for the first refresh
+            try:
+                generate_summary_image()
+            except Exception as e:
+                self.stderr.write(f'Could not render summary images: {e}')
+        scheduler = RefreshScheduler(jobs, lease_ttl=options['lease_ttl'])
+        signal.signal(signal.SIGTERM, scheduler.stop)
+        signal.signal(signal.SIGINT, scheduler.stop)
+
+        self.stdout.write(self.style.SUCCESS(f'Scheduler started as {scheduler.holder}'))
+        scheduler.run_forever()
+        self.stdout.write('Scheduler stopped')
@@ -0,0 +1,396 @@
+import atexit
+import glob
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+from django.conf import settings
+
+FILE_PREFIX = 'metrics-'
+# Samples of exited processes, folded together so the directory stays bounded
+TOTAL_FILE = f'{FILE_PREFIX}total.json'
+MERGE_LOCK_NAME = '.merge.lock'
+
+# Seconds; refresh work runs from milliseconds to minutes
+JOB_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+# name: (type, help, buckets); a histogram without buckets is fed by record_latency
+# and exports the log-linear LatencyHistogram bounds it has seen
+METRICS = {
+    'http_requests_total': ('counter', 'HTTP requests by method, route and status', None),
+    'http_request_duration_seconds': (
+        'histogram', 'HTTP request latency by method, route and status, in log-linear buckets (within 12.5%)', None,
+    ),
+    'db_queries_total': ('counter', 'Database queries run while serving requests', None),
+    'db_query_seconds_total': ('counter', 'Time spent in database queries while serving requests', None),
+    'cache_requests_total': ('counter', 'Cache lookups by result (hit or miss)', None),
+    'refresh_runs_total': ('counter', 'Refresh runs by kind and outcome', None),
+    'refresh_stage_duration_seconds': ('histogram', 'Countries refresh time per pipeline stage', JOB_BUCKETS),
+    'upstream_requests_total': ('counter', 'Upstream fetches by source and status', None),
+    'upstream_request_duration_seconds': ('histogram', 'Upstream fetch latency by source', JOB_BUCKETS),
+    'image_renders_total': ('counter', 'Summary image set renders by result (rendered or reused)', None),
+    'image_render_duration_seconds': ('histogram', 'Time to render a new summary image set', JOB_BUCKETS),
+}
+
+
+class LatencyHistogram:
+    """Log-linear buckets in the style of HdrHistogram
+
+    Each power of two of microseconds is split into SUB_BUCKETS equal
+    buckets, so any recorded value is off by at most 1/SUB_BUCKETS while
+    memory stays proportional to the range actually seen.
+    """
+
+    SUB_BUCKETS = 8
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.sum_ms = 0.0
+        self.max_ms = 0.0
+
+    @classmethod
+    def bucket_index(cls, ms):
+        micros = max(ms * 1000, 1.0)
+        exponent = int(math.log2(micros))
+        sub = int((micros / 2 ** exponent - 1) * cls.SUB_BUCKETS)
+        return exponent * cls.SUB_BUCKETS + min(sub, cls.SUB_BUCKETS - 1)
+
+    @classmethod
+    def bucket_upper_ms(cls, index):
+        exponent, sub = divmod(index, cls.SUB_BUCKETS)
+        return 2 ** exponent * (1 + (sub + 1) / cls.SUB_BUCKETS) / 1000
+
+    def record(self, ms):
+        index = self.bucket_index(ms)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.sum_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def merge(self, buckets, count, sum_ms, max_ms):
+        for index, n in buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + n
+        self.count += count
+        self.sum_ms += sum_ms
+        self.max_ms = max(self.max_ms, max_ms)
+
+
+def metrics_dir():
+    return getattr(settings, 'METRICS_DIR', None) or os.path.join(settings.CACHE_DIR, 'metrics')
+
+
+def label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class MetricsRegistry:
+    """Counters and histograms for this process, flushed to a per-process JSON file
+
+    Every gunicorn worker (and the scheduler) writes its own file, named by
+    pid and a random token so a reused pid never overwrites a dead worker's
+    totals; no locking is needed across processes and a scrape sums all the
+    files. Files of exited workers are folded into TOTAL_FILE by
+    merge_exited() so counters never go backwards.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self.file_name = f'{FILE_PREFIX}{self.pid}-{uuid.uuid4().hex[:12]}.json'
+        self.counters = {}
+        self.histograms = {}
+        self.latencies = {}
+        self.last_flush = 0.0
+
+    def _check_fork(self):
+        # A forked child inherits the parent's samples; they are the parent's to report
+        if os.getpid() != self.pid:
+            self._reset()
+
+    def inc(self, name, value=1, **labels):
+        with self._lock:
+            self._check_fork()
+            key = (name, label_key(labels))
+            self.counters[key] = self.counters.get(key, 0) + value
+        self.maybe_flush()
+
+    def observe(self, name, seconds, **labels):
+        buckets = METRICS[name][2]
+        with self._lock:
+            self._check_fork()
+            key = (name, label_key(labels))
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {'buckets': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(buckets):
+                if seconds <= bound:
+                    histogram['buckets'][i] += 1
+                    break
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+        self.maybe_flush()
+
+    def record_latency(self, name, ms, **labels):
+        """Add a duration to a log-linear histogram metric"""
+        with self._lock:
+            self._check_fork()
+            key = (name, label_key(labels))
+            histogram = self.latencies.get(key)
+            if histogram is None:
+                histogram = self.latencies[key] = LatencyHistogram()
+            histogram.record(ms)
+        self.maybe_flush()
+
+    @contextmanager
+    def time(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def snapshot(self):
+        with self._lock:
+            self._check_fork()
+            return totals_snapshot((self.counters, self.histograms, self.latencies))
+
+    def maybe_flush(self):
+        if time.monotonic() - self.last_flush >= getattr(settings, 'METRICS_FLUSH_INTERVAL', 1.0):
+            self.flush()
+
+    def flush(self):
+        """Write this process's samples atomically to its own file"""
+        self.last_flush = time.monotonic()
+        snapshot = self.snapshot()
+        if not any(snapshot.values()):
+            return
+        directory = metrics_dir()
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(snapshot, f)
+            os.replace(tmp_path, os.path.join(directory, self.file_name))
+        except OSError as e:
+            print(f"Could not write metrics: {e}")
+
+
+registry = MetricsRegistry()
+atexit.register(registry.flush)
+
+
+def record_upstream(source, seconds, error=None):
+    """Count one upstream fetch, labelled with the HTTP status when the error carries one"""
+    if error is None:
+        status = 'ok'
+    else:
+        response = getattr(error, 'response', None)
+        status = str(response.status_code) if response is not None else 'error'
+    registry.inc('upstream_requests_total', source=source, status=status)
+    registry.observe('upstream_request_duration_seconds', seconds, source=source)
+
+
+def empty_totals():
+    """(counters, histograms, latencies) to sum snapshots into"""
+    return {}, {}, {}
+
+
+def add_snapshot(totals, snapshot):
+    counters, histograms, latencies = totals
+    for name, labels, value in snapshot.get('counters', []):
+        key = (name, label_key(labels))
+        counters[key] = counters.get(key, 0) + value
+    for name, labels, buckets, total, count in snapshot.get('histograms', []):
+        if name not in METRICS or not METRICS[name][2] or len(buckets) != len(METRICS[name][2]):
+            continue
+        key = (name, label_key(labels))
+        merged = histograms.setdefault(key, {'buckets': [0] * len(buckets), 'sum': 0.0, 'count': 0})
+        merged['buckets'] = [a + b for a, b in zip(merged['buckets'], buckets)]
+        merged['sum'] += total
+        merged['count'] += count
+    for name, labels, buckets, count, sum_ms, max_ms in snapshot.get('latencies', []):
+        key = (name, label_key(labels))
+        merged = latencies.setdefault(key, LatencyHistogram())
+        # JSON object keys come back as strings
+        merged.merge({int(index): n for index, n in buckets.items()}, count, sum_ms, max_ms)
+
+
+def totals_snapshot(totals):
+    """Inverse of add_snapshot, in the format MetricsRegistry.flush writes"""
+    counters, histograms, latencies = totals
+    return {
+        'counters': [[name, dict(labels), value] for (name, labels), value in counters.items()],
+        'histograms': [
+            [name, dict(labels), h['buckets'], h['sum'], h['count']] for (name, labels), h in histograms.items()
+        ],
+        'latencies': [
+            [name, dict(labels), dict(h.buckets), h.count, h.sum_ms, h.max_ms]
+            for (name, labels), h in latencies.items()
+        ],
+    }
+
+
+def read_snapshot(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def process_files(directory):
+    """{file name: pid} of per-process files, not counting TOTAL_FILE"""
+    files = {}
+    for path in glob.glob(os.path.join(directory, f'{FILE_PREFIX}*.json')):
+        name = os.path.basename(path)
+        try:
+            files[name] = int(name[len(FILE_PREFIX):-len('.json')].split('-')[0])
+        except ValueError:
+            continue
+    return files
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+@contextmanager
+def merge_lock(directory):
+    if fcntl is None:
+        yield
+        return
+    with open(os.path.join(directory, MERGE_LOCK_NAME), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def merge_exited(directory):
+    """Fold the files of exited processes into TOTAL_FILE and delete them
+
+    Liveness is a pid check, so METRICS_DIR must only be written by
+    processes on this host. TOTAL_FILE lists the files it already holds,
+    so a crash between writing it and deleting them cannot count twice.
+    """
+    if not os.path.isdir(directory):
+        return
+    with merge_lock(directory):
+        total = read_snapshot(os.path.join(directory, TOTAL_FILE)) or {}
+        files = process_files(directory)
+        merged = {name for name in total.get('merged', []) if name in files}
+        exited = [name for name, pid in files.items() if name not in merged and not process_alive(pid)]
+        if exited:
+            totals = empty_totals()
+            add_snapshot(totals, total)
+            for name in exited:
+                snapshot = read_snapshot(os.path.join(directory, name))
+                if snapshot is not None:
+                    add_snapshot(totals, snapshot)
+                    merged.add(name)
+            total = dict(totals_snapshot(totals), merged=sorted(merged))
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(total, f)
+            os.replace(tmp_path, os.path.join(directory, TOTAL_FILE))
+        for name in merged:
+            try:
+                os.remove(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+
+
+def collect():
+    """Sum the samples of every process that has written a metrics file"""
+    registry.flush()
+    directory = metrics_dir()
+    try:
+        merge_exited(directory)
+    except OSError as e:
+        print(f"Could not merge metrics of exited processes: {e}")
+    totals = empty_totals()
+    total = read_snapshot(os.path.join(directory, TOTAL_FILE)) or {}
+    add_snapshot(totals, total)
+    merged = set(total.get('merged', []))
+    for name in process_files(directory):
+        if name in merged:
+            continue
+        snapshot = read_snapshot(os.path.join(directory, name))
+        if snapshot is not None:
+            add_snapshot(totals, snapshot)
+    return totals
+
+
+def format_labels(labels, **extra):
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ''
+    escaped = (
+        '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in pairs
+    )
+    return '{' + ','.join(escaped) + '}'
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render_prometheus():
+    """Prometheus text exposition format (0.0.4) for all processes"""
+    counters, histograms, latencies = collect()
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        if kind == 'counter':
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+            continue
+        if buckets is None:
+            # Only the log-linear bounds seen so far are listed; a series never loses one
+            for (metric, labels), histogram in sorted(latencies.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for index in sorted(histogram.buckets):
+                    cumulative += histogram.buckets[index]
+                    bound = format_value(LatencyHistogram.bucket_upper_ms(index) / 1000)
+                    lines.append(f'{name}_bucket{format_labels(labels, le=bound)} {cumulative}')
+                lines.append(f'{name}_bucket{format_labels(labels, le="+Inf")} {histogram.count}')
+                lines.append(f'{name}_sum{format_labels(labels)} {format_value(histogram.sum_ms / 1000)}')
+                lines.append(f'{name}_count{format_labels(labels)} {histogram.count}')
+            continue
+        for (metric, labels), histogram in sorted(histograms.items()):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets, histogram['buckets']):
+                cumulative += count
+                lines.append(f'{name}_bucket{format_labels(labels, le=bound)} {cumulative}')
+            lines.append(f'{name}_bucket{format_labels(labels, le="+Inf")} {histogram["count"]}')
+            lines.append(f'{name}_sum{format_labels(labels)} {format_value(histogram["sum"])}')
+            lines.append(f'{name}_count{format_labels(labels)} {histogram["count"]}')
+    return '\n'.join(lines) + '\n'
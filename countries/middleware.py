@@ -1,6 +1,55 @@
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
 from django.http import JsonResponse
 from django.utils.deprecation import MiddlewareMixin
 
+from .metrics import registry as metrics
+from .timing import timed, timing_request
+
+
+class RequestTimingMiddleware:
+    """Time each request, split out DB, cache and serialization, and keep per-route histograms
+
+    Goes first in MIDDLEWARE so the total covers every other middleware.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        start = time.perf_counter()
+        with timing_request() as timings, ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(self.time_query))
+            response = self.get_response(request)
+        total_ms = (time.perf_counter() - start) * 1000
+
+        match = getattr(request, 'resolver_match', None)
+        route = match.route if match else '<unmatched>'
+        self.record_metrics(request.method, f'/{route}', response.status_code, total_ms, timings)
+        if total_ms >= getattr(settings, 'SLOW_REQUEST_MS', 1000):
+            print(f"Slow request {request.method} /{route} {response.status_code}: {timings.server_timing(total_ms)}")
+        if getattr(settings, 'SERVER_TIMING_HEADER', False):
+            response['Server-Timing'] = timings.server_timing(total_ms)
+        return response
+
+    @staticmethod
+    def record_metrics(method, route, status, total_ms, timings):
+        metrics.inc('http_requests_total', method=method, route=route, status=status)
+        metrics.record_latency('http_request_duration_seconds', total_ms, method=method, route=route, status=status)
+        if timings.counts.get('db'):
+            metrics.inc('db_queries_total', timings.counts['db'])
+            metrics.inc('db_query_seconds_total', timings.durations['db'] / 1000)
+
+    @staticmethod
+    def time_query(execute, sql, params, many, context):
+        with timed('db'):
+            return execute(sql, params, many, context)
+
+
 class JSONErrorMiddleware(MiddlewareMixin):
     """Middleware that returns JSON errors instead of HTML"""
     def process_response(self, request, response):
@@ -22,6 +71,16 @@ class JSONErrorMiddleware(MiddlewareMixin):
                 status=500,
             )
         
+        # Convert 405 errors (e.g. from require_GET) to JSON, keeping the Allow header
+        if response.status_code == 405:
+            converted = JsonResponse(
+                {'error': 'Method not allowed'},
+                status=405,
+            )
+            if response.has_header('Allow'):
+                converted['Allow'] = response['Allow']
+            return converted
+
         # Convert 400 errors to JSON
         if response.status_code == 400:
             return JsonResponse(
@@ -0,0 +1,65 @@
+# Generated by Django 4.2.7 on 2026-10-19 18:37
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def move_currencies_to_table(apps, schema_editor):
+    Country = apps.get_model('countries', 'Country')
+    Currency = apps.get_model('countries', 'Currency')
+
+    currencies = {}
+    for country in Country.objects.exclude(currency_code__isnull=True).exclude(currency_code=''):
+        currency = currencies.get(country.currency_code)
+        if currency is None:
+            currency = Currency.objects.create(code=country.currency_code, rate=country.exchange_rate)
+            currencies[country.currency_code] = currency
+        country.currency = currency
+        country.save(update_fields=['currency'])
+
+
+def move_currencies_to_countries(apps, schema_editor):
+    Country = apps.get_model('countries', 'Country')
+    for country in Country.objects.exclude(currency__isnull=True).select_related('currency'):
+        country.currency_code = country.currency.code
+        country.exchange_rate = country.currency.rate
+        country.save(update_fields=['currency_code', 'exchange_rate'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('countries', '0004_delete_refreshlog'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Currency',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('code', models.CharField(max_length=10, unique=True)),
+                ('name', models.CharField(blank=True, max_length=100, null=True)),
+                ('symbol', models.CharField(blank=True, max_length=20, null=True)),
+                ('rate', models.FloatField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'db_table': 'currencies',
+                'ordering': ['code'],
+            },
+        ),
+        migrations.AddField(
+            model_name='country',
+            name='currency',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='countries', to='countries.currency'),
+        ),
+        migrations.RunPython(move_currencies_to_table, move_currencies_to_countries),
+        migrations.RemoveField(
+            model_name='country',
+            name='currency_code',
+        ),
+        migrations.RemoveField(
+            model_name='country',
+            name='exchange_rate',
+        ),
+    ]
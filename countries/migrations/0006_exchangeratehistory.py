@@ -0,0 +1,30 @@
+# Generated by Django 4.2.7 on 2026-10-19 18:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('countries', '0005_currency'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExchangeRateHistory',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('currency_code', models.CharField(max_length=10)),
+                ('timestamp', models.PositiveIntegerField()),
+                ('rate', models.FloatField()),
+            ],
+            options={
+                'db_table': 'exchange_rate_history',
+                'ordering': ['currency_code', 'timestamp'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='exchangeratehistory',
+            constraint=models.UniqueConstraint(fields=('currency_code', 'timestamp'), name='unique_rate_per_currency_timestamp'),
+        ),
+    ]
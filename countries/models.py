@@ -1,20 +1,84 @@
 from django.db import models
 from django.core.validators import MinValueValidator
 
+class Currency(models.Model):
+    code = models.CharField(max_length=10, unique=True)
+    name = models.CharField(max_length=100, null=True, blank=True)
+    symbol = models.CharField(max_length=20, null=True, blank=True)
+    rate = models.FloatField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'currencies'
+        ordering = ['code']
+
+    def __str__(self):
+        return self.code
+
+
+class CountryManager(models.Manager):
+    def get_queryset(self):
+        # Every read path needs the currency code and rate, so always join it
+        return super().get_queryset().select_related('currency')
+
+
 class Country(models.Model):
     name = models.CharField(max_length=100, unique=True)
     capital = models.CharField(max_length=100, null=True, blank=True)
     region = models.CharField(max_length=50, null=True, blank=True)
     population = models.BigIntegerField(validators=[MinValueValidator(0)])
-    currency_code = models.CharField(max_length=10, null=True, blank=True)
-    exchange_rate = models.FloatField(null=True, blank=True)
+    currency = models.ForeignKey(
+        Currency, null=True, blank=True, on_delete=models.SET_NULL, related_name='countries'
+    )
     estimated_gdp = models.FloatField(null=True, blank=True)
     flag_url = models.URLField(max_length=500, null=True, blank=True)
     last_refreshed_at = models.DateTimeField(auto_now=True)
-    
+
+    objects = CountryManager()
+
     class Meta:
         db_table = 'countries'
         ordering = ['name']
-    
+
+    def __str__(self):
+        return self.name
+
+    @property
+    def currency_code(self):
+        return self.currency.code if self.currency else None
+
+    @property
+    def exchange_rate(self):
+        return self.currency.rate if self.currency else None
+
+
+class ExchangeRateHistory(models.Model):
+    """One USD-based rate per currency per fetch; timestamp is epoch seconds"""
+    currency_code = models.CharField(max_length=10)
+    timestamp = models.PositiveIntegerField()
+    rate = models.FloatField()
+
+    class Meta:
+        db_table = 'exchange_rate_history'
+        ordering = ['currency_code', 'timestamp']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['currency_code', 'timestamp'], name='unique_rate_per_currency_timestamp'
+            ),
+        ]
+
+    def __str__(self):
+        return f'{self.currency_code}@{self.timestamp}'
+
+
+class SchedulerLease(models.Model):
+    """DB-backed leader lease so only one replica runs scheduled refreshes"""
+    name = models.CharField(max_length=50, unique=True)
+    holder = models.CharField(max_length=200)
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        db_table = 'scheduler_leases'
+
     def __str__(self):
-        return self.name
\ No newline at end of file
+        return f'{self.name} held by {self.holder}'
@@ -0,0 +1,355 @@
+import queue
+import threading
+import time
+from itertools import islice
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .metrics import registry as metrics
+from .models import Country
+from .services import bump_dataset_version, build_stats_rollup, mark_refreshed
+from .utils import (
+    apply_exchange_rates, count_exchange_rate_updates, estimate_gdp_array, fetch_exchange_rates, gdp_values,
+    generate_summary_image, iter_countries_data, parse_country_record, publish_exchange_rates, sync_currencies,
+)
+
+# Fields compared against the stored row to decide whether to write it
+DIFF_FIELDS = ('name', 'capital', 'region', 'population', 'currency_code', 'estimated_gdp', 'flag_url')
+
+
+def batched(iterable, size):
+    """Group an iterable into lists of at most size items"""
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def bounded_prefetch(iterable, maxsize):
+    """Consume iterable in a background thread, buffering at most maxsize items
+
+    The producer blocks when the buffer is full, so a slow consumer applies
+    backpressure upstream instead of letting memory grow.
+    """
+    if maxsize <= 0:
+        yield from iterable
+        return
+
+    buffer = queue.Queue(maxsize)
+    done = object()
+    stopped = threading.Event()
+    errors = []
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except BaseException as e:
+            errors.append(e)
+        put(done)
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is done:
+                break
+            yield item
+        if errors:
+            raise errors[0]
+    finally:
+        stopped.set()
+
+
+class StageTimings:
+    """Wall time per stage; chained stages report time excluding their upstream"""
+
+    def __init__(self):
+        self.inclusive = {}
+        self.upstream = {}
+        self.items = {}
+
+    def wrap(self, name, iterable, upstream=None):
+        self.inclusive[name] = 0.0
+        self.items[name] = 0
+        self.upstream[name] = upstream
+
+        def timed():
+            iterator = iter(iterable)
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    self.inclusive[name] += time.perf_counter() - start
+                    return
+                self.inclusive[name] += time.perf_counter() - start
+                self.items[name] += 1
+                yield item
+
+        return timed()
+
+    def measure(self, name, func, *args):
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            self.inclusive[name] = self.inclusive.get(name, 0.0) + time.perf_counter() - start
+            self.upstream.setdefault(name, None)
+
+    def as_dict(self):
+        """Exclusive milliseconds per stage, in pipeline order"""
+        timings = {}
+        for name, total in self.inclusive.items():
+            upstream = self.upstream.get(name)
+            if upstream is not None:
+                total -= self.inclusive[upstream]
+            timings[name] = round(max(total, 0.0) * 1000, 3)
+        return timings
+
+
+class RefreshPipeline:
+    """fetch -> parse -> enrich -> gdp -> diff -> write -> post-commit hooks
+
+    Stages are generators chained lazily, so records flow through one batch
+    at a time and each stage can be exercised on its own with plain lists.
+    """
+
+    def __init__(self, scope=None, dry_run=False, batch_size=None, prefetch=None):
+        self.scope = scope
+        self.dry_run = dry_run
+        self.batch_size = batch_size or getattr(settings, 'REFRESH_BATCH_SIZE', 100)
+        self.prefetch = prefetch if prefetch is not None else getattr(settings, 'REFRESH_PREFETCH', 0)
+        self.timings = StageTimings()
+        self.errors = 0
+        self.parsed = 0
+        self.created = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.deleted = 0
+        self.rescaled = 0
+        self.changes = {'created': [], 'updated': [], 'gdp_only': 0, 'deleted': [], 'rescaled': 0}
+        self.post_commit_hooks = [self.bump_version, self.rebuild_stats, self.render_image]
+
+    # Stages
+
+    def fetch(self):
+        return bounded_prefetch(iter_countries_data(self.scope), self.prefetch)
+
+    def parse(self, records):
+        seen = set()
+        for country_data in records:
+            try:
+                row = parse_country_record(country_data)
+                key = row['name'].lower()
+                if key in seen:
+                    raise ValueError('duplicate country name')
+                seen.add(key)
+            except Exception as e:
+                print(f"Error processing country {country_data.get('name')}: {e}")
+                self.errors += 1
+                continue
+            self.parsed += 1
+            yield row
+
+    def enrich(self, rows, exchange_rates):
+        for row in rows:
+            code = row['currency_code']
+            row['exchange_rate'] = exchange_rates.get(code) if code else None
+            yield row
+
+    def compute_gdp(self, batches):
+        for batch in batches:
+            estimated_gdps = gdp_values(estimate_gdp_array(
+                [row['population'] for row in batch],
+                [row['exchange_rate'] for row in batch],
+                [row['name'] for row in batch],
+            ))
+            for row, estimated_gdp in zip(batch, estimated_gdps):
+                row['estimated_gdp'] = estimated_gdp
+            yield batch
+
+    def diff(self, batches, existing):
+        """Yield (creates, updates) per batch; unmatched existing rows are left in existing"""
+        for batch in batches:
+            creates = []
+            updates = []
+            for row in batch:
+                current = existing.pop(row['name'].lower(), None)
+                if current is None:
+                    creates.append(row)
+                    continue
+                changed = [field for field in DIFF_FIELDS if current[field] != row[field]]
+                if changed:
+                    row['id'] = current['id']
+                    row['changed_fields'] = changed
+                    updates.append(row)
+                else:
+                    self.unchanged += 1
+            yield creates, updates
+
+    def write(self, changes, exchange_rates):
+        now = timezone.now()
+        if self.scope:
+            # Rates are global, so countries outside the scope that share a
+            # currency whose rate moved are rescaled like a rates refresh would
+            rates = {code: float(rate) for code, rate in exchange_rates.items() if rate}
+            _, self.rescaled = apply_exchange_rates(rates, now, changed_only=True)
+        currency_rows = sync_currencies({}, exchange_rates)
+        for creates, updates in changes:
+            # Countries reference a shared Currency row
+            currency_rows = sync_currencies(
+                {row['currency_code']: row['currency'] for row in creates + updates if row['currency']},
+                exchange_rates,
+                currency_rows,
+            )
+            Country.objects.bulk_create([self.build(row, currency_rows, now) for row in creates])
+            Country.objects.bulk_update(
+                [self.build(row, currency_rows, now) for row in updates],
+                ['name', 'capital', 'region', 'population', 'currency', 'estimated_gdp',
+                 'flag_url', 'last_refreshed_at'],
+            )
+            self.created += len(creates)
+            self.updated += len(updates)
+            yield len(creates) + len(updates)
+
+    def plan(self, changes, exchange_rates):
+        """Dry-run replacement for write: record what would change
+
+        With random multipliers every stored GDP differs from a fresh
+        estimate, so rows where only the GDP moved are counted, not listed.
+        """
+        if self.scope:
+            rates = {code: float(rate) for code, rate in exchange_rates.items() if rate}
+            self.rescaled = self.changes['rescaled'] = count_exchange_rate_updates(rates, changed_only=True)
+        random_gdp = getattr(settings, 'GDP_MULTIPLIER_MODE', 'random') == 'random'
+        for creates, updates in changes:
+            self.changes['created'] += [row['name'] for row in creates]
+            for row in updates:
+                if random_gdp and row['changed_fields'] == ['estimated_gdp']:
+                    self.changes['gdp_only'] += 1
+                else:
+                    self.changes['updated'].append({'name': row['name'], 'fields': row['changed_fields']})
+            self.created += len(creates)
+            self.updated += len(updates)
+            yield len(creates) + len(updates)
+
+    def delete_stale(self, existing):
+        # A scoped refresh only sees part of upstream, so absence proves nothing
+        if not existing or self.scope:
+            return
+        if self.dry_run:
+            self.changes['deleted'] = sorted(row['name'] for row in existing.values())
+            self.deleted = len(existing)
+            return
+        self.deleted, _ = Country.objects.filter(
+            id__in=[row['id'] for row in existing.values()]
+        ).delete()
+
+    @staticmethod
+    def build(row, currency_rows, now):
+        return Country(
+            id=row.get('id'),
+            name=row['name'],
+            capital=row['capital'],
+            region=row['region'],
+            population=row['population'],
+            currency=currency_rows.get(row['currency_code']),
+            estimated_gdp=row['estimated_gdp'],
+            flag_url=row['flag_url'],
+            last_refreshed_at=now,
+        )
+
+    # Post-commit hooks
+
+    def bump_version(self):
+        self.version = bump_dataset_version()
+
+    def rebuild_stats(self):
+        build_stats_rollup(self.version)
+
+    def render_image(self):
+        generate_summary_image()
+
+    # Driver
+
+    def load_existing(self):
+        rows = Country.objects.values(
+            'id', *[f for f in DIFF_FIELDS if f != 'currency_code'],
+            currency_code=F('currency__code'),
+        )
+        return {row['name'].lower(): row for row in rows}
+
+    def run(self):
+        timings = self.timings
+
+        print("Fetching exchange rates...")
+        exchange_rates = timings.measure('rates', fetch_exchange_rates)
+        print("Exchange rates fetched successfully")
+        if not self.dry_run:
+            timings.measure('publish_rates', publish_exchange_rates, exchange_rates)
+
+        # Readers keep seeing the previous rows until the stream is fully written
+        with transaction.atomic():
+            existing = timings.measure('load_existing', self.load_existing)
+            records = timings.wrap('fetch', self.fetch())
+            rows = timings.wrap('parse', self.parse(records), upstream='fetch')
+            rows = timings.wrap('enrich', self.enrich(rows, exchange_rates), upstream='parse')
+            batches = timings.wrap('gdp', self.compute_gdp(batched(rows, self.batch_size)), upstream='enrich')
+            changes = timings.wrap('diff', self.diff(batches, existing), upstream='gdp')
+            if self.dry_run:
+                stage = timings.wrap('plan', self.plan(changes, exchange_rates), upstream='diff')
+            else:
+                stage = timings.wrap('write', self.write(changes, exchange_rates), upstream='diff')
+            for _ in stage:
+                pass
+            timings.measure('delete', self.delete_stale, existing)
+
+        if self.dry_run:
+            return self.result(f'Dry run: {self.parsed} countries compared, nothing written')
+
+        changed = self.created or self.updated or self.deleted or self.rescaled
+        if changed:
+            for hook in self.post_commit_hooks:
+                try:
+                    timings.measure(hook.__name__, hook)
+                except Exception as e:
+                    print(f"Error in refresh hook {hook.__name__}: {e}")
+        mark_refreshed()
+        return self.result(f'Successfully refreshed {self.parsed} countries')
+
+    def result(self, message):
+        result = {
+            'message': message,
+            'dry_run': self.dry_run,
+            'total_countries': self.parsed,
+            'scope': self.scope.as_dict() if self.scope else None,
+            'errors': self.errors,
+            'created': self.created,
+            'updated': self.updated,
+            'deleted': self.deleted,
+            'unchanged': self.unchanged,
+            'rescaled': self.rescaled,
+            'timings_ms': self.timings.as_dict(),
+        }
+        if self.dry_run:
+            result['changes'] = self.changes
+        for stage, ms in result['timings_ms'].items():
+            metrics.observe('refresh_stage_duration_seconds', ms / 1000, stage=stage, dry_run=str(self.dry_run).lower())
+        print(f"Refresh finished: {result['timings_ms']}")
+        return result
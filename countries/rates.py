@@ -0,0 +1,177 @@
+import threading
+from datetime import datetime, timezone as dt_timezone
+
+import numpy as np
+from django.db.models import Avg, Count, F, Max, Min
+from django.db.models.functions import Mod
+from django.utils import timezone
+
+from .timing import timed_cache as cache
+
+EXCHANGE_RATES_KEY = 'countries:exchange_rates'
+EXCHANGE_RATES_VERSION_KEY = 'countries:exchange_rates_version'
+BASE_CURRENCY = 'USD'
+HISTORY_INTERVALS = {
+    'minute': 60,
+    'hour': 3600,
+    'day': 86400,
+    'week': 604800,
+}
+
+
+def store_exchange_rates(rates, base=BASE_CURRENCY):
+    """Publish a freshly fetched rates table to all workers"""
+    fetched_at = timezone.now()
+    version = fetched_at.strftime('%Y%m%d%H%M%S%f')
+    cache.set(EXCHANGE_RATES_KEY, {
+        'version': version,
+        'base': base,
+        'fetched_at': fetched_at.isoformat(),
+        'rates': dict(rates),
+    }, None)
+    # Written last so readers never see a version without its table
+    cache.set(EXCHANGE_RATES_VERSION_KEY, version, None)
+    return version
+
+
+class CrossRateMatrix:
+    """Dense matrix of cross rates: matrix[i, j] is units of j per unit of i"""
+
+    def __init__(self, version, base, fetched_at, rates):
+        usable = {code: float(rate) for code, rate in rates.items() if rate and rate > 0}
+        self.version = version
+        self.base = base
+        self.fetched_at = fetched_at
+        self.codes = sorted(usable)
+        self.index = {code: i for i, code in enumerate(self.codes)}
+        base_rates = np.array([usable[code] for code in self.codes], dtype=np.float64)
+        self.base_rates = base_rates
+        self.matrix = base_rates[np.newaxis, :] / base_rates[:, np.newaxis]
+
+    def position(self, code):
+        """Matrix index for a currency code, or KeyError if unknown"""
+        return self.index[code.upper()]
+
+    def rates_from(self, code):
+        """All rates quoted against the given base currency"""
+        row = self.matrix[self.position(code)]
+        return dict(zip(self.codes, row.tolist()))
+
+    def rate(self, source, target):
+        return float(self.matrix[self.position(source), self.position(target)])
+
+    def convert(self, sources, targets, amounts):
+        """Vectorized conversion; sources/targets are codes or sequences of codes"""
+        amounts = np.asarray(amounts, dtype=np.float64)
+        if isinstance(sources, str):
+            rows = self.position(sources)
+        else:
+            rows = np.fromiter((self.position(c) for c in sources), dtype=np.intp, count=len(sources))
+        if isinstance(targets, str):
+            cols = self.position(targets)
+        else:
+            cols = np.fromiter((self.position(c) for c in targets), dtype=np.intp, count=len(targets))
+        return amounts * self.matrix[rows, cols]
+
+
+_matrix = None
+_matrix_lock = threading.Lock()
+
+
+def get_cross_rates():
+    """Return the cross-rate matrix for the latest stored rates, or None"""
+    global _matrix
+    version = cache.get(EXCHANGE_RATES_VERSION_KEY)
+    if version is None:
+        return None
+    current = _matrix
+    if current is not None and current.version == version:
+        return current
+    with _matrix_lock:
+        if _matrix is None or _matrix.version != version:
+            stored = cache.get(EXCHANGE_RATES_KEY)
+            if stored is None:
+                return None
+            _matrix = CrossRateMatrix(
+                stored['version'], stored['base'], stored['fetched_at'], stored['rates']
+            )
+        return _matrix
+
+
+def record_rate_history(rates, fetched_at=None):
+    """Append one history row per currency for a rates fetch"""
+    from .models import ExchangeRateHistory
+
+    timestamp = int((fetched_at or timezone.now()).timestamp())
+    rows = [
+        ExchangeRateHistory(currency_code=code, timestamp=timestamp, rate=float(rate))
+        for code, rate in rates.items() if rate
+    ]
+    # A retried fetch in the same second is a duplicate, not an error
+    ExchangeRateHistory.objects.bulk_create(rows, batch_size=500, ignore_conflicts=True)
+    return len(rows)
+
+
+def rate_history(currency_code, start, end, interval):
+    """Downsample stored rates into fixed buckets of interval seconds"""
+    from .models import ExchangeRateHistory
+
+    buckets = (
+        ExchangeRateHistory.objects
+        .filter(
+            currency_code=currency_code.upper(),
+            timestamp__gte=int(start.timestamp()),
+            timestamp__lte=int(end.timestamp()),
+        )
+        .annotate(bucket=F('timestamp') - Mod('timestamp', interval))
+        .values('bucket')
+        .annotate(avg=Avg('rate'), low=Min('rate'), high=Max('rate'), samples=Count('id'))
+        .order_by('bucket')
+    )
+    return [
+        {
+            'timestamp': datetime.fromtimestamp(row['bucket'], tz=dt_timezone.utc).isoformat(),
+            'avg': row['avg'],
+            'min': row['low'],
+            'max': row['high'],
+            'samples': row['samples'],
+        }
+        for row in buckets
+    ]
+
+
+def archive_rate_history(before, path, delete=False):
+    """Write rows older than before to a compressed .npz archive
+
+    Timestamps are delta-encoded int64 seconds and rates are stored as
+    float32, one pair of arrays per currency.
+    """
+    from .models import ExchangeRateHistory
+
+    cutoff = int(before.timestamp())
+    old_rows = ExchangeRateHistory.objects.filter(timestamp__lt=cutoff)
+    codes = list(old_rows.order_by().values_list('currency_code', flat=True).distinct())
+    arrays = {}
+    total = 0
+    for code in codes:
+        rows = list(old_rows.filter(currency_code=code).order_by('timestamp').values_list('timestamp', 'rate'))
+        if not rows:
+            continue
+        timestamps = np.fromiter((t for t, _ in rows), dtype=np.int64, count=len(rows))
+        arrays[f'{code}__t'] = np.diff(timestamps, prepend=0)
+        arrays[f'{code}__r'] = np.fromiter((r for _, r in rows), dtype=np.float32, count=len(rows))
+        total += len(rows)
+    np.savez_compressed(path, **arrays)
+    if delete:
+        old_rows.delete()
+    return total
+
+
+def read_rate_archive(path):
+    """Load an archive written by archive_rate_history into {code: (timestamps, rates)}"""
+    with np.load(path) as archive:
+        codes = sorted({name.rsplit('__', 1)[0] for name in archive.files})
+        return {
+            code: (np.cumsum(archive[f'{code}__t']), archive[f'{code}__r'])
+            for code in codes
+        }
@@ -0,0 +1,144 @@
+import os
+import random
+import socket
+import threading
+import uuid
+from datetime import timedelta
+
+from django.db import IntegrityError, close_old_connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import SchedulerLease
+from .utils import RefreshInProgress
+
+LEASE_NAME = 'refresh-scheduler'
+
+# Cache backends whose contents other machines cannot see
+LOCAL_CACHE_BACKENDS = (
+    'django.core.cache.backends.filebased.FileBasedCache',
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+def make_holder_id():
+    return f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+
+def acquire_lease(name, holder, ttl):
+    """Take or renew the lease; returns True if holder is now the leader"""
+    now = timezone.now()
+    expires_at = now + timedelta(seconds=ttl)
+    renewed = SchedulerLease.objects.filter(name=name).filter(
+        Q(holder=holder) | Q(expires_at__lt=now)
+    ).update(holder=holder, expires_at=expires_at)
+    if renewed:
+        return True
+    try:
+        with transaction.atomic():
+            SchedulerLease.objects.create(name=name, holder=holder, expires_at=expires_at)
+        return True
+    except IntegrityError:
+        return False
+
+
+def release_lease(name, holder):
+    SchedulerLease.objects.filter(name=name, holder=holder).update(expires_at=timezone.now())
+
+
+class ScheduledJob:
+    """A periodic job with jittered interval and exponential backoff on failure"""
+
+    def __init__(self, name, func, interval, jitter=0.1, base_backoff=30, max_backoff=3600):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.jitter = jitter
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.failures = 0
+        # Spread the first run so restarted replicas do not fire together
+        self.next_run = timezone.now() + timedelta(seconds=random.uniform(0, jitter * interval))
+
+    def is_due(self, now):
+        return now >= self.next_run
+
+    def next_delay(self):
+        if self.failures:
+            backoff = min(self.max_backoff, self.base_backoff * 2 ** (self.failures - 1))
+            return random.uniform(backoff / 2, backoff)
+        return self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def run(self):
+        try:
+            result = self.func()
+            self.failures = 0
+            print(f"[scheduler] {self.name} refresh done: {result.get('message')}")
+        except RefreshInProgress as e:
+            print(f"[scheduler] {self.name} refresh skipped: {e}")
+        except Exception as e:
+            self.failures += 1
+            print(f"[scheduler] {self.name} refresh failed ({self.failures} in a row): {e}")
+        self.next_run = timezone.now() + timedelta(seconds=self.next_delay())
+
+
+class RefreshScheduler:
+    """Runs jobs only while holding the leader lease"""
+
+    def __init__(self, jobs, lease_ttl=300, holder=None, base_backoff=5, max_backoff=300):
+        self.jobs = jobs
+        self.lease_ttl = lease_ttl
+        self.holder = holder or make_holder_id()
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.failures = 0
+        self.stopped = threading.Event()
+
+    def stop(self, *args):
+        self.stopped.set()
+
+    def tick(self):
+        """Run due jobs if leader; returns seconds to wait before the next tick"""
+        close_old_connections()
+        renew_every = self.lease_ttl / 3
+        if not acquire_lease(LEASE_NAME, self.holder, self.lease_ttl):
+            return renew_every
+
+        for job in self.jobs:
+            if self.stopped.is_set():
+                break
+            if job.is_due(timezone.now()):
+                # Renew before each job so a long refresh keeps the lease
+                if not acquire_lease(LEASE_NAME, self.holder, self.lease_ttl):
+                    return renew_every
+                job.run()
+                close_old_connections()
+
+        next_run = min(job.next_run for job in self.jobs)
+        return max(0.0, min(renew_every, (next_run - timezone.now()).total_seconds()))
+
+    def safe_tick(self):
+        """tick() that survives a lost database connection; backs off while it keeps failing"""
+        try:
+            delay = self.tick()
+            self.failures = 0
+            return delay
+        except Exception as e:
+            self.failures += 1
+            # Drop the broken connection so the next tick reconnects
+            close_old_connections()
+            backoff = min(self.max_backoff, self.base_backoff * 2 ** (self.failures - 1))
+            print(f"[scheduler] tick failed ({self.failures} in a row), retrying in {backoff:.0f}s: {e}")
+            return random.uniform(backoff / 2, backoff)
+
+    def run_forever(self):
+        try:
+            while not self.stopped.is_set():
+                self.stopped.wait(self.safe_tick())
+        finally:
+            try:
+                release_lease(LEASE_NAME, self.holder)
+            except Exception as e:
+                # The lease expires on its own after lease_ttl
+                print(f"[scheduler] could not release lease: {e}")
@@ -0,0 +1,295 @@
+import heapq
+import os
+import threading
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.utils import timezone
+
+from .timing import timed_cache as cache
+
+DATASET_VERSION_KEY = 'countries:dataset_version'
+LAST_REFRESH_KEY = 'countries:last_refreshed_at'
+REFRESH_LOCK_KEY = 'countries:refresh_lock:{}'
+STATS_ROLLUP_KEY = 'countries:stats_rollup'
+UNKNOWN_GROUP = 'Unknown'
+TOP_N_FIELDS = ('estimated_gdp', 'population', 'exchange_rate')
+TOP_N_MAX = 250
+
+
+def get_dataset_version():
+    """Return the current dataset version shared by all workers"""
+    version = cache.get(DATASET_VERSION_KEY)
+    if version is None:
+        version = bump_dataset_version()
+    return version
+
+
+def bump_dataset_version():
+    """Mark the countries table as changed and return the new version"""
+    version = timezone.now().strftime('%Y%m%d%H%M%S%f')
+    cache.set(DATASET_VERSION_KEY, version, None)
+    return version
+
+
+def mark_refreshed(at=None):
+    """Record when a refresh last completed, even if it changed no rows"""
+    at = at or timezone.now()
+    cache.set(LAST_REFRESH_KEY, at, None)
+    return at
+
+
+def get_last_refreshed_at():
+    return cache.get(LAST_REFRESH_KEY)
+
+
+@contextmanager
+def refresh_lock(name):
+    """Best-effort cross-worker lock; yields False if another refresh holds it"""
+    key = REFRESH_LOCK_KEY.format(name)
+    timeout = getattr(settings, 'REFRESH_LOCK_TIMEOUT', 600)
+    acquired = cache.add(key, os.getpid(), timeout)
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            cache.delete(key)
+
+
+class NegativeLookupCache:
+    """Bounded LRU of country names known to be missing for a dataset version"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.version = None
+        self._names = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _sync(self, version):
+        if version != self.version:
+            self._names.clear()
+            self.version = version
+
+    def contains(self, name, version):
+        key = name.lower()
+        with self._lock:
+            self._sync(version)
+            if key not in self._names:
+                return False
+            self._names.move_to_end(key)
+            return True
+
+    def add(self, name, version):
+        if self.max_size <= 0:
+            return
+        key = name.lower()
+        with self._lock:
+            self._sync(version)
+            self._names[key] = True
+            self._names.move_to_end(key)
+            while len(self._names) > self.max_size:
+                self._names.popitem(last=False)
+
+
+negative_lookup_cache = NegativeLookupCache(
+    getattr(settings, 'NEGATIVE_LOOKUP_CACHE_SIZE', 10000)
+)
+
+
+class DatasetSnapshot:
+    """Per-worker copy of the serialized countries for one dataset version"""
+
+    def __init__(self):
+        self.version = None
+        self.rows = []
+        self.regions = frozenset()
+        self._top_cache = {}
+        self._lock = threading.Lock()
+
+    def _load(self, version):
+        from .models import Country
+        from .serializers import CountrySerializer
+
+        rows = [dict(row) for row in CountrySerializer(Country.objects.all(), many=True).data]
+        self.rows = rows
+        self.regions = frozenset((row['region'] or '').lower() for row in rows)
+        self._top_cache = {}
+        self.version = version
+
+    def get_rows(self):
+        version = get_dataset_version()
+        with self._lock:
+            if version != self.version:
+                self._load(version)
+            return self.rows
+
+    def top(self, field, n, region=None):
+        """Return the n countries with the largest non-null value of field"""
+        rows = self.get_rows()
+        key = (field, n, region.lower() if region else None)
+        # Only regions in the data are cached, so arbitrary ?region= values cannot grow the cache
+        if key[2] is not None and key[2] not in self.regions:
+            return []
+        with self._lock:
+            cached = self._top_cache.get(key)
+        if cached is not None:
+            return cached
+
+        candidates = (
+            row for row in rows
+            if row[field] is not None
+            and (key[2] is None or (row['region'] or '').lower() == key[2])
+        )
+        result = heapq.nlargest(n, candidates, key=lambda row: row[field])
+        with self._lock:
+            # Skip caching if another thread loaded a newer version meanwhile
+            if rows is self.rows:
+                self._top_cache[key] = result
+        return result
+
+
+dataset_snapshot = DatasetSnapshot()
+
+
+def top_countries(field, n, region=None):
+    """Top-n countries by a numeric field, cached per dataset version"""
+    return dataset_snapshot.top(field, n, region)
+
+
+def _empty_group():
+    return {'count': 0, 'populations': [], 'gdps': [], 'rates': []}
+
+
+def _add_to_group(group, row):
+    group['count'] += 1
+    insort(group['populations'], row['population'] or 0)
+    if row['estimated_gdp'] is not None:
+        insort(group['gdps'], (row['estimated_gdp'], row['name']))
+    if row['exchange_rate'] is not None:
+        insort(group['rates'], row['exchange_rate'])
+
+
+def _discard_sorted(values, value):
+    index = bisect_left(values, value)
+    if index < len(values) and values[index] == value:
+        del values[index]
+
+
+def _remove_from_group(group, row):
+    group['count'] -= 1
+    _discard_sorted(group['populations'], row['population'] or 0)
+    if row['estimated_gdp'] is not None:
+        _discard_sorted(group['gdps'], (row['estimated_gdp'], row['name']))
+    if row['exchange_rate'] is not None:
+        _discard_sorted(group['rates'], row['exchange_rate'])
+
+
+def _rollup_keys(row):
+    return (
+        ('regions', row['region'] or UNKNOWN_GROUP),
+        ('currencies', row['currency_code'] or UNKNOWN_GROUP),
+    )
+
+
+def _stats_row(country):
+    return {
+        'name': country.name,
+        'region': country.region,
+        'currency_code': country.currency_code,
+        'population': country.population,
+        'estimated_gdp': country.estimated_gdp,
+        'exchange_rate': country.exchange_rate,
+    }
+
+
+def build_stats_rollup(version=None):
+    """Aggregate every country into per-region and per-currency groups"""
+    from django.db.models import F
+    from .models import Country
+
+    rollup = {'version': version or get_dataset_version(), 'regions': {}, 'currencies': {}}
+    rows = Country.objects.values(
+        'name', 'region', 'population', 'estimated_gdp',
+        currency_code=F('currency__code'), exchange_rate=F('currency__rate'),
+    )
+    for row in rows:
+        for dimension, key in _rollup_keys(row):
+            _add_to_group(rollup[dimension].setdefault(key, _empty_group()), row)
+    cache.set(STATS_ROLLUP_KEY, rollup, None)
+    return rollup
+
+
+def remove_country_from_stats(country, previous_version, version):
+    """Update the stored rollup for a single deleted country
+
+    The in-place update is only safe when the stored rollup is exactly the
+    one from before this delete bumped the version; anything else is
+    rebuilt. If another delete holds the lock the rollup is left alone and
+    readers rebuild it, since its version no longer matches.
+    """
+    with refresh_lock('stats') as acquired:
+        if not acquired:
+            return None
+        rollup = cache.get(STATS_ROLLUP_KEY)
+        if rollup is None or rollup['version'] != previous_version:
+            return build_stats_rollup(version)
+
+        row = _stats_row(country)
+        for dimension, key in _rollup_keys(row):
+            group = rollup[dimension].get(key)
+            if group is None:
+                continue
+            _remove_from_group(group, row)
+            if group['count'] <= 0:
+                del rollup[dimension][key]
+        rollup['version'] = version
+        cache.set(STATS_ROLLUP_KEY, rollup, None)
+        return rollup
+
+
+def _median(values):
+    if not values:
+        return None
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2
+
+
+def _summarize_group(group):
+    populations = group['populations']
+    gdps = group['gdps']
+    rates = group['rates']
+    total_population = sum(populations)
+    top_gdp = gdps[-1] if gdps else None
+    return {
+        'count': group['count'],
+        'population': {
+            'total': total_population,
+            'mean': total_population / len(populations) if populations else None,
+            'median': _median(populations),
+        },
+        'estimated_gdp': {
+            'total': sum(gdp for gdp, _ in gdps) if gdps else None,
+            'top': {'name': top_gdp[1], 'estimated_gdp': top_gdp[0]} if top_gdp else None,
+        },
+        'exchange_rate': {
+            'min': rates[0] if rates else None,
+            'max': rates[-1] if rates else None,
+        },
+    }
+
+
+def get_country_stats():
+    """Return region and currency aggregates for the current dataset version"""
+    version = get_dataset_version()
+    rollup = cache.get(STATS_ROLLUP_KEY)
+    if rollup is None or rollup['version'] != version:
+        rollup = build_stats_rollup(version)
+    return {
+        'version': rollup['version'],
+        'regions': {k: _summarize_group(g) for k, g in sorted(rollup['regions'].items())},
+        'currencies': {k: _summarize_group(g) for k, g in sorted(rollup['currencies'].items())},
+    }
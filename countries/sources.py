@@ -0,0 +1,238 @@
+import codecs
+import json
+
+import requests
+from urllib.parse import quote
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+COUNTRIES_FIELDS = 'name,alpha2Code,alpha3Code,capital,region,population,flag,currencies'
+STREAM_CHUNK_SIZE = 64 * 1024
+
+DEFAULT_SOURCES = {
+    'countries': {
+        'BACKEND': 'countries.sources.RestCountriesSource',
+        'LOCATION': 'https://restcountries.com/v2',
+    },
+    'rates': {
+        'BACKEND': 'countries.sources.OpenErApiRatesSource',
+        'LOCATION': 'https://open.er-api.com/v6',
+    },
+}
+
+
+def iter_json_array(chunks):
+    """Yield the elements of a top-level JSON array from an iterable of text chunks
+
+    Each element is decoded as soon as its closing bracket arrives, so the
+    whole document is never held in memory.
+    """
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    buffer = ''
+    pos = 0
+    exhausted = False
+
+    def refill():
+        nonlocal buffer, pos, exhausted
+        for chunk in chunks:
+            if chunk:
+                buffer = buffer[pos:] + chunk
+                pos = 0
+                return True
+        exhausted = True
+        return False
+
+    def skip_whitespace():
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n':
+                pos += 1
+            if pos < len(buffer) or not refill():
+                return pos < len(buffer)
+
+    if not skip_whitespace() or buffer[pos] != '[':
+        raise ValueError('Expected a JSON array')
+    pos += 1
+    # True right after '[' or ',', where only a value (or ']' for an empty array) may follow
+    expect_value = True
+    empty = True
+
+    while True:
+        if not skip_whitespace():
+            raise ValueError('Unterminated JSON array')
+        if buffer[pos] == ']':
+            if expect_value and not empty:
+                raise ValueError(f'Trailing comma in JSON array at position {pos}')
+            return
+        if buffer[pos] == ',':
+            if expect_value:
+                raise ValueError(f'Unexpected comma in JSON array at position {pos}')
+            pos += 1
+            expect_value = True
+            continue
+        try:
+            value, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if exhausted or not refill():
+                raise
+            continue
+        # A number cut at a chunk boundary decodes as a shorter prefix, so only
+        # accept a value once the following separator has arrived
+        following = end
+        while following < len(buffer) and buffer[following] in ' \t\r\n':
+            following += 1
+        if following == len(buffer) or buffer[following] not in ',]':
+            if not exhausted and refill():
+                continue
+            if following < len(buffer):
+                raise ValueError(f'Unexpected data in JSON array at position {following}')
+        pos = end
+        expect_value = False
+        empty = False
+        yield value
+
+
+class RefreshScope:
+    """Subset of countries a refresh is limited to; an empty scope means all"""
+
+    def __init__(self, regions=None, names=None, currencies=None, codes=None):
+        self.regions = sorted({r.strip().lower() for r in regions or [] if r.strip()})
+        self.names = sorted({n.strip().lower() for n in names or [] if n.strip()})
+        self.currencies = sorted({c.strip().upper() for c in currencies or [] if c.strip()})
+        self.codes = sorted({c.strip().upper() for c in codes or [] if c.strip()})
+
+    def __bool__(self):
+        return bool(self.regions or self.names or self.currencies or self.codes)
+
+    def as_dict(self):
+        return {
+            'regions': self.regions,
+            'names': self.names,
+            'currencies': self.currencies,
+            'codes': self.codes,
+        }
+
+    def matches(self, record):
+        """Whether an upstream record falls inside the scope"""
+        if not self:
+            return True
+        currencies = {(c.get('code') or '').upper() for c in record.get('currencies') or []}
+        codes = {(record.get('alpha2Code') or '').upper(), (record.get('alpha3Code') or '').upper()}
+        return (
+            (record.get('region') or '').lower() in self.regions
+            or (record.get('name') or '').lower() in self.names
+            or bool(currencies.intersection(self.currencies))
+            or bool(codes.intersection(self.codes))
+        )
+
+
+class CountriesSource:
+    """Base class for adapters that return restcountries v2 shaped records"""
+
+    def __init__(self, location, options=None):
+        self.location = location
+        self.options = options or {}
+
+    def iter_records(self, scope=None):
+        """Yield the records inside scope (all when None) one at a time"""
+        raise NotImplementedError
+
+    def fetch(self):
+        return list(self.iter_records())
+
+
+class RatesSource:
+    """Base class for adapters that return a {code: rate} mapping against USD"""
+
+    def __init__(self, location, options=None):
+        self.location = location
+        self.options = options or {}
+
+    def fetch(self):
+        raise NotImplementedError
+
+
+class RestCountriesSource(CountriesSource):
+    """restcountries.com v2 API, or any mirror serving the same paths"""
+
+    def scoped_urls(self, scope):
+        """Smallest set of v2 endpoints covering the scope"""
+        base = self.location.rstrip('/')
+        fields = f"fields={self.options.get('fields', COUNTRIES_FIELDS)}"
+        if not scope:
+            return [f'{base}/all?{fields}']
+        # safe='' so a '/' or '?' in a value cannot change the path or query
+        urls = [f"{base}/region/{quote(region, safe='')}?{fields}" for region in scope.regions]
+        urls += [f"{base}/name/{quote(name, safe='')}?fullText=true&{fields}" for name in scope.names]
+        urls += [f"{base}/currency/{quote(code, safe='')}?{fields}" for code in scope.currencies]
+        if scope.codes:
+            codes = ','.join(quote(code, safe='') for code in scope.codes)
+            urls.append(f"{base}/alpha?codes={codes}&{fields}")
+        return urls
+
+    def iter_records(self, scope=None):
+        seen = set()
+        for url in self.scoped_urls(scope):
+            for record in self.stream(url, allow_missing=bool(scope)):
+                # Scoped endpoints can overlap (a region and a currency)
+                if record.get('name') not in seen:
+                    seen.add(record.get('name'))
+                    yield record
+
+    def stream(self, url, allow_missing=False):
+        print(f"Fetching from: {url}")
+        with requests.get(url, timeout=self.options.get('timeout', 30), stream=True) as response:
+            print(f"Response status: {response.status_code}")
+            if allow_missing and response.status_code == 404:
+                return
+            response.raise_for_status()
+            decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')()
+            chunks = (
+                decoder.decode(chunk)
+                for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE)
+            )
+            yield from iter_json_array(chunks)
+
+
+class OpenErApiRatesSource(RatesSource):
+    """open.er-api.com v6 latest rates, or any mirror serving the same paths"""
+
+    def fetch(self):
+        url = f"{self.location.rstrip('/')}/latest/{self.options.get('base', 'USD')}"
+        print(f"Fetching from: {url}")
+        response = requests.get(url, timeout=self.options.get('timeout', 30))
+        print(f"Response status: {response.status_code}")
+        response.raise_for_status()
+        data = response.json()
+        print(f"Exchange API result: {data.get('result')}")
+        if data.get('result') != 'success':
+            raise ValueError("Exchange rate API returned unsuccessful result")
+        return data['rates']
+
+
+class FileCountriesSource(CountriesSource):
+    """Recorded countries payload read from a JSON file"""
+
+    def iter_records(self, scope=None):
+        with open(self.location, encoding='utf-8') as f:
+            for record in iter_json_array(iter(lambda: f.read(STREAM_CHUNK_SIZE), '')):
+                if scope is None or scope.matches(record):
+                    yield record
+
+
+class FileRatesSource(RatesSource):
+    """Recorded rates payload read from a JSON file (full API body or bare rates)"""
+
+    def fetch(self):
+        with open(self.location, encoding='utf-8') as f:
+            data = json.load(f)
+        return data['rates'] if 'rates' in data else data
+
+
+def get_source(kind):
+    """Instantiate the adapter configured for 'countries' or 'rates'"""
+    config = getattr(settings, 'COUNTRY_DATA_SOURCES', {}).get(kind) or DEFAULT_SOURCES[kind]
+    backend = import_string(config['BACKEND'])
+    return backend(config.get('LOCATION', DEFAULT_SOURCES[kind]['LOCATION']), config.get('OPTIONS'))
@@ -1,3 +1,716 @@
-from django.test import TestCase
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from django.db import OperationalError, connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from . import metrics
+from .images import SummaryLayout, images_root, prune_versions, summary_image_cache, write_layouts
+from .models import Country, Currency, ExchangeRateHistory, SchedulerLease
+from .pipeline import RefreshPipeline
+from .rates import CrossRateMatrix, archive_rate_history, rate_history, read_rate_archive, record_rate_history
+from .scheduler import LEASE_NAME, RefreshScheduler, acquire_lease, release_lease
+from .services import (
+    NegativeLookupCache, build_stats_rollup, bump_dataset_version, dataset_snapshot, get_country_stats,
+    refresh_lock, remove_country_from_stats, top_countries,
+)
+from .sources import CountriesSource, RefreshScope, RestCountriesSource, iter_json_array
+from .utils import (
+    apply_exchange_rates, calculate_estimated_gdp, estimate_gdp_array, gdp_multipliers, gdp_values,
+    generate_summary_image,
+)
+
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+_module_settings = None
+
+
+def setUpModule():
+    # Metrics files and image sets go to a scratch directory, never the repo's cache/
+    global _module_settings
+    tmp = tempfile.mkdtemp(prefix='countries-tests-')
+    _module_settings = override_settings(CACHE_DIR=tmp, METRICS_DIR=os.path.join(tmp, 'metrics'))
+    _module_settings.enable()
+
+
+def tearDownModule():
+    tmp = settings.CACHE_DIR
+    # Drop this process's samples so the atexit flush has nothing left to write
+    metrics.registry._reset()
+    _module_settings.disable()
+    shutil.rmtree(tmp, ignore_errors=True)
+
+
+def chunked(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+class IterJsonArrayTests(SimpleTestCase):
+    document = json.dumps([
+        {'name': 'Côte d\'Ivoire', 'population': 26378275, 'area': 322463.5},
+        {'name': 'Quote "and" \\ backslash', 'population': -12, 'rate': 1.5e-7},
+        123456789, 3.14159, 'a, ], string', [1, [2, 3]], True, None,
+    ])
+
+    def test_matches_json_loads(self):
+        self.assertEqual(list(iter_json_array([self.document])), json.loads(self.document))
+
+    def test_every_chunk_boundary(self):
+        # Splits land inside numbers, strings, escapes and between tokens
+        expected = json.loads(self.document)
+        for size in range(1, 12):
+            with self.subTest(size=size):
+                self.assertEqual(list(iter_json_array(chunked(self.document, size))), expected)
+
+    def test_number_split_before_closing_bracket(self):
+        self.assertEqual(list(iter_json_array(['[12', '34', '5]'])), [12345])
+        self.assertEqual(list(iter_json_array(['[1.', '5e', '3 ', ']'])), [1500.0])
+
+    def test_empty_chunks_and_whitespace(self):
+        self.assertEqual(list(iter_json_array(['', ' [ ', '', ' ]', ''])), [])
+        self.assertEqual(list(iter_json_array(['\n[\n1\n,\n2\n]\n'])), [1, 2])
+
+    def test_malformed_input(self):
+        for text in ['', '{}', '[', '[1', '[1,', '[1,,2]', '[1,]', '[,1]', '[1 2]', '["open]']:
+            with self.subTest(text=text):
+                with self.assertRaises(ValueError):
+                    list(iter_json_array(chunked(text, 2) or ['']))
+
+    def test_stops_at_closing_bracket(self):
+        self.assertEqual(list(iter_json_array(['[1, 2]', ' trailing text is never read'])), [1, 2])
+
+
+class CountriesSourceTests(SimpleTestCase):
+    def test_adapter_must_implement_iter_records(self):
+        with self.assertRaises(NotImplementedError):
+            CountriesSource('unused').fetch()
+
+    def test_scoped_urls_escape_path_characters(self):
+        source = RestCountriesSource('https://example.test/v2/', {'fields': 'name'})
+        scope = RefreshScope(regions=['Europe/../all'], names=['a?b'], currencies=['x&y'], codes=['ng#'])
+        self.assertEqual(source.scoped_urls(scope), [
+            'https://example.test/v2/region/europe%2F..%2Fall?fields=name',
+            'https://example.test/v2/name/a%3Fb?fullText=true&fields=name',
+            'https://example.test/v2/currency/X%26Y?fields=name',
+            'https://example.test/v2/alpha?codes=NG%23&fields=name',
+        ])
+
+
+
+@override_settings(CACHES=LOCMEM_CACHES, BATCH_LOOKUP_MAX_NAMES=3)
+class CountryBatchViewTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        Country.objects.create(name='France', region='Europe', population=67)
+        Country.objects.create(name='Ghana', region='Africa', population=31)
+
+    def test_get_keeps_request_order_and_reports_missing(self):
+        with self.assertNumQueries(1):
+            body = self.client.get('/countries/batch?names=ghana, Atlantis ,France').json()
+        self.assertEqual(list(body['results']), ['ghana', 'Atlantis', 'France'])
+        self.assertEqual(body['results']['ghana']['name'], 'Ghana')
+        self.assertIsNone(body['results']['Atlantis'])
+        self.assertEqual(body['not_found'], ['Atlantis'])
+
+    def test_post_list_and_missing_names_are_remembered(self):
+        self.client.post('/countries/batch', {'names': ['Atlantis']}, content_type='application/json')
+        with self.assertNumQueries(0):
+            body = self.client.post('/countries/batch', ['Atlantis'], content_type='application/json').json()
+        self.assertEqual(body['not_found'], ['Atlantis'])
+
+    def test_validation(self):
+        for response in (
+            self.client.get('/countries/batch'),
+            self.client.get('/countries/batch?names=a,b,c,d'),
+            self.client.post('/countries/batch', {'names': 'France'}, content_type='application/json'),
+        ):
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json()['error'], 'Validation failed')
+
+class CrossRateMatrixTests(SimpleTestCase):
+    def setUp(self):
+        self.matrix = CrossRateMatrix('v1', 'USD', None, {
+            'USD': 1, 'EUR': 0.5, 'NGN': 1500.0, 'XXX': 0, 'YYY': None,
+        })
+
+    def test_unusable_rates_are_dropped(self):
+        self.assertEqual(self.matrix.codes, ['EUR', 'NGN', 'USD'])
+
+    def test_rate(self):
+        self.assertEqual(self.matrix.rate('usd', 'eur'), 0.5)
+        self.assertEqual(self.matrix.rate('EUR', 'NGN'), 3000.0)
+        self.assertEqual(self.matrix.rate('NGN', 'NGN'), 1.0)
+
+    def test_convert_one_pair(self):
+        self.assertEqual(self.matrix.convert('USD', 'EUR', [2, 10]).tolist(), [1.0, 5.0])
+
+    def test_convert_per_amount_pairs(self):
+        results = self.matrix.convert(['USD', 'EUR'], ['NGN', 'USD'], [1, 1])
+        self.assertEqual(results.tolist(), [1500.0, 2.0])
+
+    def test_unknown_currency(self):
+        with self.assertRaises(KeyError):
+            self.matrix.convert('USD', 'XXX', [1])
+        with self.assertRaises(KeyError):
+            self.matrix.rate('ABC', 'USD')
+
+
+
+@override_settings(GDP_MULTIPLIER_MODE='stable', GDP_MULTIPLIER_SEED='test')
+class ApplyExchangeRatesTests(TestCase):
+    def setUp(self):
+        eur = Currency.objects.create(code='EUR', rate=0.5)
+        ngn = Currency.objects.create(code='NGN', rate=None)
+        ghs = Currency.objects.create(code='GHS', rate=10.0)
+        Country.objects.create(name='France', population=67, currency=eur, estimated_gdp=100.0)
+        Country.objects.create(name='Nigeria', population=206, currency=ngn, estimated_gdp=None)
+        Country.objects.create(name='Ghana', population=31, currency=ghs, estimated_gdp=50.0)
+        self.now = timezone.now()
+
+    def gdp(self, name):
+        return Country.objects.get(name=name).estimated_gdp
+
+    def test_rescaled_gained_and_dropped_currencies(self):
+        self.assertEqual(apply_exchange_rates({'EUR': 0.25, 'NGN': 1500.0}, self.now), (3, 3))
+        self.assertEqual(self.gdp('France'), 200.0)
+        self.assertEqual(self.gdp('Nigeria'), calculate_estimated_gdp(206, 1500.0, 'Nigeria'))
+        self.assertIsNone(self.gdp('Ghana'))
+        self.assertEqual(
+            dict(Currency.objects.values_list('code', 'rate')), {'EUR': 0.25, 'NGN': 1500.0, 'GHS': None}
+        )
+
+    def test_changed_only_leaves_unmoved_rates_alone(self):
+        before = Country.objects.get(name='France').last_refreshed_at
+        self.assertEqual(apply_exchange_rates({'EUR': 0.5, 'GHS': 5.0}, self.now, changed_only=True), (3, 1))
+        self.assertEqual(Country.objects.get(name='France').last_refreshed_at, before)
+        self.assertEqual(self.gdp('Ghana'), 100.0)
+
+
+class RateHistoryTests(TestCase):
+    def setUp(self):
+        self.start = datetime(2026, 1, 1, tzinfo=dt_timezone.utc)
+        for minutes, rate in ((0, 0.90), (20, 0.94), (59, 0.92), (60, 0.80)):
+            record_rate_history({'EUR': rate, 'USD': 1, 'XXX': None}, self.start + timedelta(minutes=minutes))
+
+    def test_record_skips_missing_rates_and_duplicate_fetches(self):
+        self.assertEqual(record_rate_history({'EUR': 0.5}, self.start), 1)
+        self.assertEqual(ExchangeRateHistory.objects.filter(currency_code='EUR').count(), 4)
+        self.assertFalse(ExchangeRateHistory.objects.filter(currency_code='XXX').exists())
+
+    def test_hourly_downsampling(self):
+        history = rate_history('eur', self.start, self.start + timedelta(hours=2), 3600)
+        self.assertEqual(
+            [row['timestamp'] for row in history], ['2026-01-01T00:00:00+00:00', '2026-01-01T01:00:00+00:00']
+        )
+        self.assertAlmostEqual(history[0]['avg'], 0.92)
+        self.assertEqual((history[0]['min'], history[0]['max'], history[0]['samples']), (0.90, 0.94, 3))
+        self.assertEqual(history[1]['samples'], 1)
+
+    def test_archive_round_trip(self):
+        path = os.path.join(tempfile.mkdtemp(), 'rates.npz')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path), ignore_errors=True)
+        total = archive_rate_history(self.start + timedelta(minutes=60), path, delete=True)
+        self.assertEqual(total, 6)
+        self.assertEqual(list(ExchangeRateHistory.objects.values_list('currency_code', flat=True)), ['EUR', 'USD'])
+
+        archive = read_rate_archive(path)
+        timestamps, rates = archive['EUR']
+        base = int(self.start.timestamp())
+        self.assertEqual(timestamps.tolist(), [base, base + 1200, base + 3540])
+        self.assertEqual(rates.dtype.name, 'float32')
+        self.assertEqual(rates.tolist(), np.float32([0.90, 0.94, 0.92]).tolist())
+        self.assertEqual(archive['USD'][1].tolist(), [1.0, 1.0, 1.0])
+
+
+class GdpEstimateTests(SimpleTestCase):
+    def test_stable_multipliers_depend_only_on_name_and_seed(self):
+        first = gdp_multipliers(['France', 'Ghana'], mode='stable', seed='s1')
+        self.assertEqual(first.tolist(), gdp_multipliers(['France', 'Ghana'], mode='stable', seed='s1').tolist())
+        self.assertEqual(gdp_multipliers(['Ghana'], mode='stable', seed='s1')[0], first[1])
+        self.assertNotEqual(first.tolist(), gdp_multipliers(['France', 'Ghana'], mode='stable', seed='s2').tolist())
+        self.assertTrue(all(1000 <= m <= 2000 for m in first))
+
+    def test_random_multipliers_stay_in_range(self):
+        multipliers = gdp_multipliers(['x'] * 500, mode='random')
+        self.assertTrue(((multipliers >= 1000) & (multipliers <= 2000)).all())
+
+    def test_missing_or_zero_rates_give_no_gdp(self):
+        gdp = estimate_gdp_array([10, 10, 10], [2.0, None, 0], ['a', 'b', 'c'], mode='stable', seed='')
+        self.assertEqual(gdp[0], 10 * gdp_multipliers(['a'], mode='stable', seed='')[0] / 2.0)
+        self.assertEqual(gdp_values(gdp)[1:], [None, None])
+
+class NegativeLookupCacheTests(SimpleTestCase):
+    def test_names_are_case_insensitive(self):
+        misses = NegativeLookupCache(10)
+        misses.add('Atlantis', 'v1')
+        self.assertTrue(misses.contains('ATLANTIS', 'v1'))
+        self.assertFalse(misses.contains('Lemuria', 'v1'))
+
+    def test_new_version_forgets_misses(self):
+        misses = NegativeLookupCache(10)
+        misses.add('Atlantis', 'v1')
+        self.assertFalse(misses.contains('Atlantis', 'v2'))
+        self.assertFalse(misses.contains('Atlantis', 'v1'))
+
+    def test_least_recently_used_is_evicted(self):
+        misses = NegativeLookupCache(2)
+        misses.add('a', 'v1')
+        misses.add('b', 'v1')
+        misses.contains('a', 'v1')
+        misses.add('c', 'v1')
+        self.assertTrue(misses.contains('a', 'v1'))
+        self.assertFalse(misses.contains('b', 'v1'))
+        self.assertTrue(misses.contains('c', 'v1'))
+
+    def test_zero_size_disables(self):
+        misses = NegativeLookupCache(0)
+        misses.add('a', 'v1')
+        self.assertFalse(misses.contains('a', 'v1'))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class StatsRollupTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        ngn = Currency.objects.create(code='NGN', rate=1500.0)
+        eur = Currency.objects.create(code='EUR', rate=0.92)
+        Country.objects.create(name='Nigeria', region='Africa', population=200, currency=ngn, estimated_gdp=300.0)
+        Country.objects.create(name='France', region='Europe', population=67, currency=eur, estimated_gdp=100.0)
+        Country.objects.create(name='Germany', region='Europe', population=83, currency=eur, estimated_gdp=150.0)
+        Country.objects.create(name='Antarctica', region=None, population=1)
+
+    def test_summary(self):
+        stats = get_country_stats()
+        self.assertEqual(sorted(stats['regions']), ['Africa', 'Europe', 'Unknown'])
+        europe = stats['regions']['Europe']
+        self.assertEqual(europe['count'], 2)
+        self.assertEqual(europe['population'], {'total': 150, 'mean': 75.0, 'median': 75.0})
+        self.assertEqual(europe['estimated_gdp'], {'total': 250.0, 'top': {'name': 'Germany', 'estimated_gdp': 150.0}})
+        self.assertEqual(stats['currencies']['Unknown']['count'], 1)
+
+    def test_remove_matches_full_rebuild(self):
+        build_stats_rollup('v1')
+        for previous, version, name in (('v1', 'v2', 'Germany'), ('v2', 'v3', 'Antarctica')):
+            country = Country.objects.get(name=name)
+            country.delete()
+            updated = remove_country_from_stats(country, previous, version)
+        self.assertEqual(updated, build_stats_rollup('v3'))
+        self.assertNotIn('Unknown', updated['regions'])
+        self.assertEqual(updated['currencies']['EUR']['gdps'], [(100.0, 'France')])
+
+    def test_remove_rebuilds_when_rollup_is_not_the_previous_version(self):
+        build_stats_rollup('v1')
+        germany = Country.objects.get(name='Germany')
+        germany.delete()
+        Country.objects.get(name='France').delete()
+        # Another delete already bumped past v1, so France was never removed in place
+        updated = remove_country_from_stats(germany, 'v2', 'v3')
+        self.assertEqual(updated, build_stats_rollup('v3'))
+        self.assertNotIn('Europe', updated['regions'])
+
+    def test_remove_skips_while_another_delete_holds_the_lock(self):
+        build_stats_rollup('v1')
+        germany = Country.objects.get(name='Germany')
+        germany.delete()
+        with refresh_lock('stats'):
+            self.assertIsNone(remove_country_from_stats(germany, 'v1', 'v2'))
+        self.assertEqual(get_country_stats()['regions']['Europe']['count'], 1)
+
+    def test_delete_endpoint_updates_stats(self):
+        response = self.client.delete('/countries/germany')
+        self.assertEqual(response.status_code, 204)
+        europe = self.client.get('/countries/stats').json()['regions']['Europe']
+        self.assertEqual(europe['count'], 1)
+        self.assertEqual(europe['estimated_gdp']['top']['name'], 'France')
+        self.assertEqual(self.client.delete('/countries/germany').status_code, 404)
+
+    def test_top_countries_by_region(self):
+        self.assertEqual([row['name'] for row in top_countries('estimated_gdp', 5, 'europe')], ['Germany', 'France'])
+        self.assertEqual(top_countries('estimated_gdp', 5, 'Atlantis'), [])
+        self.assertNotIn(('estimated_gdp', 5, 'atlantis'), dataset_snapshot._top_cache)
+
+
+COUNTRIES = [
+    {'name': 'Nigeria', 'alpha2Code': 'NG', 'capital': 'Abuja', 'region': 'Africa', 'population': 200000000,
+     'flag': 'https://flags.example/ng.svg', 'currencies': [{'code': 'NGN', 'name': 'Naira', 'symbol': 'N'}]},
+    {'name': 'France', 'alpha2Code': 'FR', 'capital': 'Paris', 'region': 'Europe', 'population': 67000000,
+     'flag': 'https://flags.example/fr.svg', 'currencies': [{'code': 'EUR', 'name': 'Euro', 'symbol': 'E'}]},
+    {'name': 'Germany', 'alpha2Code': 'DE', 'capital': 'Berlin', 'region': 'Europe', 'population': 83000000,
+     'flag': 'https://flags.example/de.svg', 'currencies': [{'code': 'EUR', 'name': 'Euro', 'symbol': 'E'}]},
+    {'name': 'Antarctica', 'alpha2Code': 'AQ', 'region': 'Polar', 'population': 1000,
+     'flag': 'https://flags.example/aq.svg'},
+]
+RATES = {'result': 'success', 'rates': {'USD': 1, 'NGN': 1500.0, 'EUR': 0.92}}
+
+
+@override_settings(CACHES=LOCMEM_CACHES, GDP_MULTIPLIER_MODE='stable')
+class RefreshPipelineTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        self.countries_path = os.path.join(self.tmp, 'countries.json')
+        self.rates_path = os.path.join(self.tmp, 'rates.json')
+        self.write_fixtures(COUNTRIES, RATES)
+        sources = override_settings(
+            COUNTRY_DATA_SOURCES={
+                'countries': {'BACKEND': 'countries.sources.FileCountriesSource', 'LOCATION': self.countries_path},
+                'rates': {'BACKEND': 'countries.sources.FileRatesSource', 'LOCATION': self.rates_path},
+            },
+        )
+        sources.enable()
+        self.addCleanup(sources.disable)
+
+    def write_fixtures(self, countries, rates):
+        with open(self.countries_path, 'w') as f:
+            json.dump(countries, f)
+        with open(self.rates_path, 'w') as f:
+            json.dump(rates, f)
+
+    def run_pipeline(self, **kwargs):
+        pipeline = RefreshPipeline(batch_size=2, **kwargs)
+        # Rendering images is covered by its own command, not needed here
+        pipeline.post_commit_hooks = [pipeline.bump_version, pipeline.rebuild_stats]
+        return pipeline.run()
+
+    def test_first_refresh_creates_everything(self):
+        result = self.run_pipeline()
+        self.assertEqual((result['created'], result['updated'], result['deleted']), (4, 0, 0))
+        france = Country.objects.get(name='France')
+        self.assertEqual(france.currency_code, 'EUR')
+        self.assertEqual(france.exchange_rate, 0.92)
+        self.assertIsNone(Country.objects.get(name='Antarctica').estimated_gdp)
+
+    def test_unchanged_input_writes_nothing(self):
+        self.run_pipeline()
+        result = self.run_pipeline()
+        self.assertEqual((result['created'], result['updated'], result['unchanged']), (0, 0, 4))
+
+    def test_dry_run_reports_changes_without_writing(self):
+        self.run_pipeline()
+        countries = [dict(c) for c in COUNTRIES if c['name'] != 'Antarctica']
+        countries[0]['population'] = 210000000
+        countries.append({'name': 'Ghana', 'region': 'Africa', 'population': 31000000,
+                          'currencies': [{'code': 'GHS'}]})
+        self.write_fixtures(countries, RATES)
+        before = list(Country.objects.values_list('name', 'population', 'estimated_gdp'))
+
+        result = self.run_pipeline(dry_run=True)
+        self.assertTrue(result['dry_run'])
+        self.assertEqual(result['changes'], {
+            'created': ['Ghana'],
+            'updated': [{'name': 'Nigeria', 'fields': ['population', 'estimated_gdp']}],
+            'gdp_only': 0,
+            'deleted': ['Antarctica'],
+            'rescaled': 0,
+        })
+        self.assertEqual(list(Country.objects.values_list('name', 'population', 'estimated_gdp')), before)
+
+        result = self.run_pipeline()
+        self.assertEqual((result['created'], result['updated'], result['deleted']), (1, 1, 1))
+        self.assertEqual(Country.objects.get(name='Nigeria').population, 210000000)
+        self.assertFalse(Country.objects.filter(name='Antarctica').exists())
+
+    def test_dry_run_counts_gdp_only_changes_with_random_multipliers(self):
+        self.run_pipeline()
+        countries = [dict(c) for c in COUNTRIES]
+        countries[0]['population'] = 210000000
+        self.write_fixtures(countries, RATES)
+
+        with override_settings(GDP_MULTIPLIER_MODE='random'):
+            changes = self.run_pipeline(dry_run=True)['changes']
+        self.assertEqual([row['name'] for row in changes['updated']], ['Nigeria'])
+        self.assertEqual(changes['gdp_only'], 2)
+
+    def test_scoped_dry_run_reports_planned_rescales(self):
+        self.run_pipeline()
+        self.write_fixtures(COUNTRIES, {'result': 'success', 'rates': {'USD': 1, 'NGN': 1500.0, 'EUR': 0.46}})
+
+        result = self.run_pipeline(scope=RefreshScope(names=['France']), dry_run=True)
+        self.assertEqual(result['rescaled'], 2)
+        self.assertEqual(result['changes']['rescaled'], 2)
+        self.assertEqual(Country.objects.get(name='Germany').exchange_rate, 0.92)
+
+    def test_scoped_refresh_rescales_countries_sharing_a_moved_rate(self):
+        self.run_pipeline()
+        germany_gdp = Country.objects.get(name='Germany').estimated_gdp
+        self.write_fixtures(COUNTRIES, {'result': 'success', 'rates': {'USD': 1, 'NGN': 1500.0, 'EUR': 0.46}})
+
+        result = self.run_pipeline(scope=RefreshScope(names=['France']))
+        self.assertEqual(result['updated'], 1)
+        self.assertEqual(result['deleted'], 0)
+        germany = Country.objects.get(name='Germany')
+        self.assertEqual(germany.exchange_rate, 0.46)
+        self.assertAlmostEqual(germany.estimated_gdp, germany_gdp * 2)
+
+
+class SchedulerLeaseTests(TestCase):
+    def test_acquire_renew_and_expiry(self):
+        self.assertTrue(acquire_lease(LEASE_NAME, 'a', 60))
+        self.assertTrue(acquire_lease(LEASE_NAME, 'a', 60))
+        self.assertFalse(acquire_lease(LEASE_NAME, 'b', 60))
+
+        SchedulerLease.objects.filter(name=LEASE_NAME).update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertTrue(acquire_lease(LEASE_NAME, 'b', 60))
+        self.assertFalse(acquire_lease(LEASE_NAME, 'a', 60))
+
+    def test_release_lets_another_holder_take_over(self):
+        self.assertTrue(acquire_lease(LEASE_NAME, 'a', 60))
+        release_lease(LEASE_NAME, 'a')
+        self.assertTrue(acquire_lease(LEASE_NAME, 'b', 60))
+
+    def test_tick_errors_back_off_instead_of_stopping(self):
+        scheduler = RefreshScheduler([], holder='a', base_backoff=4, max_backoff=8)
+        with mock.patch('countries.scheduler.acquire_lease', side_effect=OperationalError('gone away')):
+            delays = [scheduler.safe_tick() for _ in range(3)]
+        self.assertEqual(scheduler.failures, 3)
+        self.assertTrue(2 <= delays[0] <= 4)
+        self.assertTrue(4 <= delays[2] <= 8)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, IMAGE_RENDER_WORKERS=1)
+class SummaryImageViewTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        summary_image_cache.forget_published()
+        eur = Currency.objects.create(code='EUR', rate=0.5)
+        Country.objects.create(name='France', region='Europe', population=67, currency=eur, estimated_gdp=100.0)
+        Country.objects.create(name='Germany', region='Europe', population=83, currency=eur, estimated_gdp=150.0)
+
+    def publish(self):
+        generate_summary_image()
+        summary_image_cache.forget_published()
+
+    def test_cold_start_is_503_without_rendering(self):
+        with mock.patch('countries.utils.render_summary_images') as render:
+            response = self.client.get('/countries/image')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '30')
+        render.assert_not_called()
+
+    def test_etag_and_not_modified(self):
+        self.publish()
+        response = self.client.get('/countries/image', HTTP_ACCEPT='image/png')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertTrue(response.content.startswith(b'\x89PNG'))
+        etag = response['ETag']
+
+        response = self.client.get('/countries/image', HTTP_ACCEPT='image/png', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(response.content, b'')
+
+    def test_format_negotiation_and_region_images(self):
+        self.publish()
+        response = self.client.get('/countries/image?size=thumb', HTTP_ACCEPT='image/webp,image/*')
+        self.assertEqual(response['Content-Type'], 'image/webp')
+        self.assertIn('Accept', response['Vary'])
+        response = self.client.get('/countries/image?format=svg&region=Europe')
+        self.assertEqual(response['Content-Type'], 'image/svg+xml')
+        self.assertIn(b'Germany', response.content)
+        self.assertEqual(self.client.get('/countries/image?region=Atlantis').status_code, 404)
+        self.assertEqual(self.client.get('/countries/image?size=huge').status_code, 400)
+
+    def test_unchanged_content_reuses_the_image_set(self):
+        first = generate_summary_image()
+        bump_dataset_version()
+        self.assertEqual(generate_summary_image(), first)
+        Country.objects.filter(name='France').update(estimated_gdp=300.0)
+        bump_dataset_version()
+        self.assertNotEqual(generate_summary_image(), first)
+
+    def test_digest_url_is_immutable(self):
+        self.publish()
+        location = self.client.get('/countries/image?format=png')['Content-Location']
+        response = self.client.get(location)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertIn('max-age=31536000', response['Cache-Control'])
+        self.assertEqual(self.client.get(location.replace('.png', '.gif')).status_code, 404)
+
+    def test_sendfile_backends_leave_the_body_to_the_proxy(self):
+        self.publish()
+        with override_settings(IMAGE_SENDFILE_BACKEND='nginx', IMAGE_SENDFILE_PREFIX='/protected/'):
+            response = self.client.get('/countries/image?format=png')
+        digest, name = summary_image_cache.locate(['summary-1x.png'])
+        self.assertEqual(response['X-Accel-Redirect'], f'/protected/{digest}/{name}')
+        self.assertEqual(response.content, b'')
+
+        with override_settings(IMAGE_SENDFILE_BACKEND='sendfile'):
+            response = self.client.get('/countries/image?format=png')
+        self.assertEqual(response['X-Sendfile'], os.path.join(images_root(), digest, name))
+
+    def test_sendfile_of_a_pruned_variant_is_404(self):
+        self.publish()
+        with override_settings(IMAGE_SENDFILE_BACKEND='sendfile'), \
+                mock.patch('countries.views.image_set_file', return_value=None):
+            response = self.client.get('/countries/image?format=png')
+        self.assertEqual(response.status_code, 404)
+        self.assertNotIn('X-Sendfile', response)
+
+    def test_other_methods_are_json_405(self):
+        response = self.client.post('/countries/image')
+        self.assertEqual(response.status_code, 405)
+        self.assertEqual(response.json(), {'error': 'Method not allowed'})
+        self.assertEqual(response['Allow'], 'GET')
+
+
+class PruneVersionsTests(SimpleTestCase):
+    def setUp(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp, ignore_errors=True)
+        overrides = override_settings(CACHE_DIR=tmp, REFRESH_LOCK_TIMEOUT=600)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        os.makedirs(images_root())
+
+    def make_dir(self, name, age):
+        path = os.path.join(images_root(), name)
+        os.mkdir(path)
+        stamp = time.time() - age
+        os.utime(path, (stamp, stamp))
+
+    def test_keeps_newest_sets_and_drops_abandoned_renders(self):
+        for i, name in enumerate(['a' * 32, 'b' * 32, 'c' * 32]):
+            self.make_dir(name, age=300 - i)
+        self.make_dir('.render-killed', age=3600)
+        self.make_dir('.render-running', age=10)
+
+        prune_versions(2)
+        self.assertEqual(sorted(os.listdir(images_root())), ['.render-running', 'b' * 32, 'c' * 32])
+
+
+@override_settings(IMAGE_RENDER_WORKERS=4)
+class RenderPoolTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        layout = SummaryLayout(80, 40)
+        layout.text(4, 4, 'Top 5')
+        self.layouts = {None: layout, 'Europe': layout}
+
+    def test_web_processes_render_in_process(self):
+        with mock.patch('countries.images._render_pool_enabled', False), \
+                mock.patch('countries.images.get_render_pool') as get_pool:
+            manifest = write_layouts(self.directory, self.layouts)
+        get_pool.assert_not_called()
+        self.assertIn('summary-europe-1x.png', manifest['variants'])
+
+    def test_enabled_processes_use_the_pool(self):
+        with mock.patch('countries.images._render_pool_enabled', True), \
+                mock.patch('countries.images.get_render_pool') as get_pool:
+            get_pool.return_value.map.return_value = [{'a.png': 1}, {'b.png': 2}]
+            manifest = write_layouts(self.directory, self.layouts)
+        get_pool.assert_called_once_with(4)
+        self.assertEqual(manifest['variants'], {'a.png': 1, 'b.png': 2})
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class RequestTimingTests(TestCase):
+    def test_server_timing_header_is_opt_in(self):
+        self.assertNotIn('Server-Timing', self.client.get('/countries/stats'))
+
+        with override_settings(SERVER_TIMING_HEADER=True):
+            header = self.client.get('/countries/stats')['Server-Timing']
+        self.assertTrue(header.startswith('total;dur='))
+        self.assertIn('cache;dur=', header)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class MetricsTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        overrides = override_settings(METRICS_DIR=self.directory)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        # Start from no samples so counts do not depend on which tests ran first
+        metrics.registry._reset()
+
+    def exited_pid(self):
+        process = subprocess.Popen([sys.executable, '-c', 'pass'])
+        process.wait()
+        return process.pid
+
+    def test_request_latency_is_a_histogram_by_route_and_status(self):
+        self.client.get('/countries/stats')
+        body = self.client.get('/metrics').content.decode()
+        self.assertIn('# TYPE http_request_duration_seconds histogram', body)
+        labels = 'method="GET",route="/countries/stats",status="200"'
+        self.assertIn(f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}} 1', body)
+        self.assertIn(f'http_request_duration_seconds_count{{{labels}}} 1', body)
+        self.assertIn(f'http_requests_total{{{labels}}} 1', body)
+        buckets = [line for line in body.splitlines()
+                   if line.startswith(f'http_request_duration_seconds_bucket{{{labels},le="0')]
+        self.assertEqual(buckets[-1].rsplit(' ', 1)[1], '1')
+
+    def test_exited_process_files_are_folded_into_the_total(self):
+        snapshot = {'counters': [['refresh_runs_total', {'kind': 'rates', 'outcome': 'ok'}, 2]]}
+        # Same pid twice: a reused pid gets its own file instead of overwriting
+        pid = self.exited_pid()
+        for token in ('a', 'b'):
+            with open(os.path.join(self.directory, f'metrics-{pid}-{token}.json'), 'w') as f:
+                json.dump(snapshot, f)
+        metrics.registry.inc('cache_requests_total', result='hit')
+
+        for _ in range(2):
+            counters = metrics.collect()[0]
+            self.assertEqual(counters[('refresh_runs_total', (('kind', 'rates'), ('outcome', 'ok')))], 4)
+        names = os.listdir(self.directory)
+        self.assertIn(metrics.TOTAL_FILE, names)
+        self.assertNotIn(f'metrics-{pid}-a.json', names)
+        self.assertIn(metrics.registry.file_name, names)
+
+    def test_disabled_endpoint_is_404(self):
+        with override_settings(METRICS_ENABLED=False):
+            self.assertEqual(self.client.get('/metrics').status_code, 404)
+
+
+class CurrencyMigrationTests(TransactionTestCase):
+    before = [('countries', '0004_delete_refreshlog')]
+    after = [('countries', '0005_currency')]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        self.migrate(MigrationExecutor(connection).loader.graph.leaf_nodes())
+
+    def test_currencies_move_to_their_own_table_and_back(self):
+        apps = self.migrate(self.before)
+        OldCountry = apps.get_model('countries', 'Country')
+        for name, code, rate in (('France', 'EUR', 0.92), ('Germany', 'EUR', 0.92), ('Nigeria', 'NGN', None),
+                                 ('Antarctica', None, None)):
+            OldCountry.objects.create(name=name, population=1, currency_code=code, exchange_rate=rate)
+
+        apps = self.migrate(self.after)
+        Currency = apps.get_model('countries', 'Currency')
+        Country = apps.get_model('countries', 'Country')
+        self.assertEqual(dict(Currency.objects.values_list('code', 'rate')), {'EUR': 0.92, 'NGN': None})
+        self.assertEqual(
+            dict(Country.objects.values_list('name', 'currency__code')),
+            {'France': 'EUR', 'Germany': 'EUR', 'Nigeria': 'NGN', 'Antarctica': None},
+        )
+
+        apps = self.migrate(self.before)
+        OldCountry = apps.get_model('countries', 'Country')
+        self.assertEqual(
+            sorted(OldCountry.objects.values_list('name', 'currency_code', 'exchange_rate')),
+            [('Antarctica', None, None), ('France', 'EUR', 0.92), ('Germany', 'EUR', 0.92), ('Nigeria', 'NGN', None)],
+        )
@@ -0,0 +1,82 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.core.cache import cache as default_cache
+from rest_framework.renderers import JSONRenderer
+
+from .metrics import registry as metrics
+
+_current = ContextVar('request_timings', default=None)
+
+
+class RequestTimings:
+    """Milliseconds and call counts per category (db, cache, serialize) for one request"""
+
+    def __init__(self):
+        self.durations = {}
+        self.counts = {}
+
+    def add(self, name, ms):
+        self.durations[name] = self.durations.get(name, 0.0) + ms
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    def server_timing(self, total_ms):
+        """Server-Timing header value, total first"""
+        parts = [f'total;dur={total_ms:.3f}']
+        for name, ms in self.durations.items():
+            parts.append(f'{name};dur={ms:.3f};desc="{self.counts[name]} calls"')
+        return ', '.join(parts)
+
+
+@contextmanager
+def timed(name):
+    """Book the wrapped block under name for the current request, if one is being timed"""
+    timings = _current.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, (time.perf_counter() - start) * 1000)
+
+
+@contextmanager
+def timing_request():
+    timings = RequestTimings()
+    token = _current.set(timings)
+    try:
+        yield timings
+    finally:
+        _current.reset(token)
+
+
+class TimedCache:
+    """Proxy for the default cache that books every call under 'cache' and counts hits and misses"""
+
+    def __getattr__(self, name):
+        attr = getattr(default_cache, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            with timed('cache'):
+                result = attr(*args, **kwargs)
+            if name == 'get':
+                metrics.inc('cache_requests_total', result='miss' if result is None else 'hit')
+            return result
+
+        return call
+
+
+timed_cache = TimedCache()
+
+
+class TimedJSONRenderer(JSONRenderer):
+    """JSONRenderer that books encoding time under 'serialize'"""
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        with timed('serialize'):
+            return super().render(data, accepted_media_type, renderer_context)
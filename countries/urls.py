@@ -8,6 +8,10 @@ urlpatterns = [
     path('refresh', views.refresh_countries, name='refresh-countries'),
     path('', views.CountryListView.as_view(), name='country-list'),
     path('image', views.countries_image, name='countries-image'),
+    path('image/<str:digest>/<str:name>', views.countries_image_file, name='countries-image-file'),
     path('status', views.status_view, name='status'),
+    path('stats', views.country_stats, name='country-stats'),
+    path('top', views.country_top, name='country-top'),
+    path('batch', views.CountryBatchView.as_view(), name='country-batch'),
     path('<str:name>', views.CountryDetailView.as_view(), name='country-detail'),
 ]
\ No newline at end of file
@@ -1,225 +1,421 @@
 import requests
-import random
+import hashlib
 from datetime import datetime
-import os
-from PIL import Image, ImageDraw, ImageFont
+from functools import lru_cache, wraps
+import time
+import numpy as np
 import io
 from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, FloatField, Value, When
 from django.utils import timezone
-from .models import Country
+from django.utils.dateparse import parse_datetime
+from .models import Country, Currency
+from .rates import store_exchange_rates, record_rate_history
+from .sources import get_source
+from .metrics import record_upstream, registry as metrics
+from .images import SummaryLayout, render_summary_images
+from .services import (
+    bump_dataset_version, build_stats_rollup, dataset_snapshot, get_dataset_version,
+    mark_refreshed, refresh_lock, top_countries,
+)
 
 def fetch_countries_data():
-    """Fetch country data from restcountries API"""
-    try:
-        url = 'https://restcountries.com/v2/all?fields=name,capital,region,population,flag,currencies'
-        print(f"Fetching from: {url}")
-        response = requests.get(url, timeout=30)
-        print(f"Response status: {response.status_code}")
-        response.raise_for_status()
-        data = response.json()
-        print(f"Received {len(data)} countries")
-        return data
-    except requests.RequestException as e:
-        print(f"Countries API error: {str(e)}")
-        raise Exception(f"Could not fetch data from Countries API: {str(e)}")
+    """Fetch country data from the configured countries source"""
+    data = list(iter_countries_data())
+    print(f"Received {len(data)} countries")
+    return data
 
 def fetch_exchange_rates():
-    """Fetch exchange rates from open.er-api.com"""
+    """Fetch exchange rates from the configured rates source"""
+    start = time.perf_counter()
     try:
-        url = 'https://open.er-api.com/v6/latest/USD'
-        print(f"Fetching from: {url}")
-        response = requests.get(url, timeout=30)
-        print(f"Response status: {response.status_code}")
-        response.raise_for_status()
-        data = response.json()
-        print(f"Exchange API result: {data.get('result')}")
-        if data.get('result') == 'success':
-            return data['rates']
-        else:
-            raise Exception("Exchange rate API returned unsuccessful result")
-    except requests.RequestException as e:
+        rates = get_source('rates').fetch()
+    except (requests.RequestException, OSError, ValueError, KeyError) as e:
+        record_upstream('rates', time.perf_counter() - start, e)
         print(f"Exchange API error: {str(e)}")
         raise Exception(f"Could not fetch data from Exchange Rates API: {str(e)}")
-def calculate_estimated_gdp(population, exchange_rate):
+    record_upstream('rates', time.perf_counter() - start)
+    return rates
+
+_rng = np.random.default_rng()
+
+
+@lru_cache(maxsize=4096)
+def _stable_multiplier(name, seed):
+    digest = hashlib.blake2b(f'{seed}:{name}'.encode(), digest_size=8).digest()
+    return 1000 + int.from_bytes(digest, 'big') % 1001
+
+
+def gdp_multipliers(names, mode=None, seed=None):
+    """GDP multipliers in [1000, 2000], fresh per call or stable per country name"""
+    mode = mode or getattr(settings, 'GDP_MULTIPLIER_MODE', 'random')
+    if mode == 'stable':
+        seed = seed if seed is not None else getattr(settings, 'GDP_MULTIPLIER_SEED', '')
+        return np.fromiter(
+            (_stable_multiplier(name, seed) for name in names), dtype=np.float64, count=len(names)
+        )
+    return _rng.integers(1000, 2000, size=len(names), endpoint=True).astype(np.float64)
+
+
+def estimate_gdp_array(populations, exchange_rates, names, mode=None, seed=None):
+    """Vectorized GDP estimate; NaN where the exchange rate is missing or zero"""
+    populations = np.asarray(populations, dtype=np.float64)
+    rates = np.array([rate or np.nan for rate in exchange_rates], dtype=np.float64)
+    multipliers = gdp_multipliers(names, mode, seed)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        gdp = populations * multipliers / rates
+    gdp[~np.isfinite(gdp)] = np.nan
+    return gdp
+
+
+def gdp_values(gdp):
+    """Convert a GDP array to Python floats with None for missing values"""
+    return [None if np.isnan(value) else value for value in gdp.tolist()]
+
+
+def calculate_estimated_gdp(population, exchange_rate, name=''):
     """Calculate estimated GDP using population and exchange rate"""
-    if not exchange_rate:
-        return None
-    
     try:
-        population_val = float(population)
-        exchange_rate_val = float(exchange_rate)
-        
-        if exchange_rate_val == 0:
-            return None
-            
-        multiplier = random.randint(1000, 2000)
-        gdp = (population_val * multiplier) / exchange_rate_val
-        return float(gdp)
-    except (TypeError, ValueError, ZeroDivisionError):
+        return gdp_values(estimate_gdp_array([population], [exchange_rate], [name]))[0]
+    except (TypeError, ValueError):
         return None
 
 
+def counted_refresh(kind):
+    """Count runs of a refresh function by outcome; dry runs are counted separately"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            label = f'{kind}_dry_run' if kwargs.get('dry_run') else kind
+            outcome = 'error'
+            try:
+                result = func(*args, **kwargs)
+                outcome = 'success'
+                return result
+            except RefreshInProgress:
+                outcome = 'busy'
+                raise
+            finally:
+                metrics.inc('refresh_runs_total', kind=label, outcome=outcome)
+        return wrapper
+    return decorator
 
-def refresh_countries_data():
-    """Main function to refresh countries data"""
-    from .models import Country
-    
+
+class RefreshInProgress(Exception):
+    """Raised when another worker already holds the refresh lock"""
+
+
+def publish_exchange_rates(exchange_rates):
+    """Share fetched rates with all workers and append them to the history"""
+    store_exchange_rates(exchange_rates)
     try:
-        # Fetch data from external APIs
-        print("Fetching countries data...")
-        countries_data = fetch_countries_data()
-        print(f"Fetched {len(countries_data)} countries")
-        
+        record_rate_history(exchange_rates)
+    except Exception as e:
+        print(f"Error recording rate history: {e}")
+
+
+def _rate_changes(currencies, rates, changed_only):
+    """Split currencies into (rescale, gained, dropped) against new rates"""
+    rescale = [c for c in currencies if c.rate and c.code in rates]
+    if changed_only:
+        rescale = [c for c in rescale if c.rate != rates[c.code]]
+    gained = [c for c in currencies if not c.rate and c.code in rates]
+    dropped = [c for c in currencies if c.rate and c.code not in rates]
+    return rescale, gained, dropped
+
+
+def count_exchange_rate_updates(rates, changed_only=False):
+    """Countries apply_exchange_rates would update, without writing anything"""
+    rescale, gained, dropped = _rate_changes(list(Currency.objects.all()), rates, changed_only)
+    return Country.objects.filter(currency__in=rescale + gained + dropped).count()
+
+
+def apply_exchange_rates(rates, now, changed_only=False):
+    """Store new rates on Currency and move every country's GDP with its currency's rate
+
+    Call inside a transaction. changed_only leaves countries whose rate did
+    not move untouched. Returns (currencies, countries updated).
+    """
+    currencies = list(Currency.objects.select_for_update())
+    rescale, gained, dropped = _rate_changes(currencies, rates, changed_only)
+
+    # Rescale GDP by old/new rate so every country keeps its multiplier
+    rescaled = 0
+    if rescale:
+        ratio = Case(
+            *[When(currency_id=c.pk, then=Value(c.rate / rates[c.code])) for c in rescale],
+            output_field=FloatField(),
+        )
+        rescaled = Country.objects.filter(currency__in=rescale).update(
+            estimated_gdp=F('estimated_gdp') * ratio,
+            last_refreshed_at=now,
+        )
+
+    # Countries whose currency just gained a rate need a fresh multiplier
+    gained_countries = list(Country.objects.filter(currency__in=gained)) if gained else []
+    for country in gained_countries:
+        country.estimated_gdp = calculate_estimated_gdp(
+            country.population, rates[country.currency.code], country.name
+        )
+        country.last_refreshed_at = now
+    Country.objects.bulk_update(gained_countries, ['estimated_gdp', 'last_refreshed_at'])
+
+    # Currencies that dropped out of the rates feed lose their GDP, as in a full refresh
+    cleared = 0
+    if dropped:
+        cleared = Country.objects.filter(currency__in=dropped).update(
+            estimated_gdp=None, last_refreshed_at=now
+        )
+
+    # One row per currency instead of one per country
+    for currency in currencies:
+        currency.rate = rates.get(currency.code)
+        currency.updated_at = now
+    Currency.objects.bulk_update(currencies, ['rate', 'updated_at'])
+    return len(currencies), rescaled + len(gained_countries) + cleared
+
+
+@counted_refresh('rates')
+def refresh_exchange_rates():
+    """Refresh exchange rates and recompute GDP without refetching countries"""
+    with refresh_lock('rates') as acquired:
+        if not acquired:
+            raise RefreshInProgress("An exchange rates refresh is already running")
+
         print("Fetching exchange rates...")
         exchange_rates = fetch_exchange_rates()
-        print("Exchange rates fetched successfully")
-        
-        created_count = 0
-        updated_count = 0
-        error_count = 0
-        
-        # Clear existing data to avoid duplicates
-        Country.objects.all().delete()
-        print("Cleared existing countries data")
-        
-        for country_data in countries_data:
-            try:
-                # Extract currency code (first one if multiple)
-                currency_code = None
-                currencies = country_data.get('currencies', [])
-                if currencies and len(currencies) > 0:
-                    currency_code = currencies[0].get('code')
-                
-                # Get exchange rate
-                exchange_rate = None
-                if currency_code and currency_code in exchange_rates:
-                    exchange_rate = exchange_rates[currency_code]
-                
-                # Calculate estimated GDP
-                estimated_gdp = calculate_estimated_gdp(
-                    country_data.get('population', 0), 
-                    exchange_rate
-                )
-                
-                # Create country record
-                Country.objects.create(
-                    name=country_data['name'],
-                    capital=country_data.get('capital'),
-                    region=country_data.get('region'),
-                    population=int(country_data.get('population', 0)),
-                    currency_code=currency_code,
-                    exchange_rate=exchange_rate,
-                    estimated_gdp=estimated_gdp,
-                    flag_url=country_data.get('flag'),
-                )
-                created_count += 1
-                    
-            except Exception as e:
-                print(f"Error processing country {country_data.get('name')}: {e}")
-                error_count += 1
-                continue
-        
-        # Ensure cache directory exists
-        os.makedirs(settings.CACHE_DIR, exist_ok=True)
-        
-        # Generate summary image
-        print("Generating summary image...")
+        publish_exchange_rates(exchange_rates)
+
+        rates = {code: float(rate) for code, rate in exchange_rates.items() if rate}
+        now = timezone.now()
+
+        with transaction.atomic():
+            currencies, countries_updated = apply_exchange_rates(rates, now)
+
+        version = bump_dataset_version()
+        mark_refreshed()
+        try:
+            build_stats_rollup(version)
+        except Exception as e:
+            print(f"Error building stats rollup: {e}")
+        # GDP moved, so the top five may have; an unchanged image is not re-rendered
         try:
             generate_summary_image()
-            print("Summary image generated")
         except Exception as e:
-            print(f"Error generating image: {e}")
-        
+            print(f"Error rendering summary image: {e}")
+
         return {
-            'message': f'Successfully refreshed {created_count} countries',
-            'total_countries': created_count,
-            'errors': error_count
+            'message': f'Successfully refreshed {len(rates)} exchange rates',
+            'total_rates': len(rates),
+            'currencies_updated': currencies,
+            'countries_updated': countries_updated,
         }
-        
-    except Exception as e:
-        print(f"Error in refresh_countries_data: {e}")
-        raise e
 
 
+def sync_currencies(currency_info, exchange_rates, known=None):
+    """Upsert Currency rows for currency_info and return all rows keyed by code
+
+    Rows in known that are already up to date are not written again, so this
+    can be called once per batch during a streaming refresh.
+    """
+    if known is None:
+        known = Currency.objects.in_bulk(field_name='code')
+    now = timezone.now()
+    to_create = []
+    to_update = []
+    for code, info in currency_info.items():
+        if code not in known:
+            to_create.append(Currency(
+                code=code,
+                name=info.get('name'),
+                symbol=info.get('symbol'),
+                rate=exchange_rates.get(code),
+            ))
+    for code, currency in known.items():
+        info = currency_info.get(code, {})
+        values = (
+            info.get('name', currency.name),
+            info.get('symbol', currency.symbol),
+            exchange_rates.get(code),
+        )
+        if values != (currency.name, currency.symbol, currency.rate):
+            currency.name, currency.symbol, currency.rate = values
+            currency.updated_at = now
+            to_update.append(currency)
+    Currency.objects.bulk_create(to_create)
+    Currency.objects.bulk_update(to_update, ['name', 'symbol', 'rate', 'updated_at'])
+    if to_create:
+        # MySQL does not return primary keys from bulk_create, so reload
+        known.update(Currency.objects.in_bulk([c.code for c in to_create], field_name='code'))
+    return known
+
+
+def iter_countries_data(scope=None):
+    """Stream country records from the configured countries source
+
+    Upstream latency only counts time spent waiting on the source, not time
+    the consumer spends between records.
+    """
+    records = iter(get_source('countries').iter_records(scope))
+    waited = 0.0
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                record = next(records, None)
+            finally:
+                waited += time.perf_counter() - start
+            if record is None:
+                break
+            yield record
+    except (requests.RequestException, OSError, ValueError) as e:
+        record_upstream('countries', waited, e)
+        print(f"Countries API error: {str(e)}")
+        raise Exception(f"Could not fetch data from Countries API: {str(e)}")
+    record_upstream('countries', waited)
+
 
+def parse_country_record(country_data):
+    """Normalize one upstream record into the fields stored on Country"""
+    # Extract currency (first one if multiple)
+    currency = None
+    currencies = country_data.get('currencies') or []
+    if currencies and currencies[0].get('code'):
+        currency = currencies[0]
+    
+    return {
+        'name': country_data['name'],
+        'capital': country_data.get('capital'),
+        'region': country_data.get('region'),
+        'population': int(country_data.get('population', 0)),
+        'currency': currency,
+        'currency_code': currency['code'] if currency else None,
+        'flag_url': country_data.get('flag'),
+    }
+
+
+@counted_refresh('countries')
+def refresh_countries_data(scope=None, dry_run=False):
+    """Main function to refresh countries data, optionally limited to a RefreshScope
+
+    A dry run computes the change set without writing anything, so it does
+    not need the refresh lock.
+    """
+    from .pipeline import RefreshPipeline
+    if dry_run:
+        return RefreshPipeline(scope=scope, dry_run=True).run()
+    with refresh_lock('countries') as acquired:
+        if not acquired:
+            raise RefreshInProgress("A countries refresh is already running")
+        try:
+            return RefreshPipeline(scope=scope).run()
+        except Exception as e:
+            print(f"Error in refresh_countries_data: {e}")
+            raise e
 
 
 def generate_summary_image():
-    """Generate summary image with countries data"""
+    """Render the summary image variants for the current dataset version, at most once"""
+    return render_summary_images(get_dataset_version(), build_summary_layouts)
+
+
+def build_summary_layouts():
+    """The global summary plus one chart layout per region, keyed by region (None for global)"""
+    layouts = {None: build_summary_layout()}
+    try:
+        layouts.update(build_region_layouts())
+    except Exception as e:
+        print(f"Error generating region images: {e}")
+    return layouts
+
+
+def displayed_refresh_time(rows):
+    """Latest refresh among serialized rows; rows are only rewritten when they change"""
+    stamps = [parse_datetime(row['last_refreshed_at']) for row in rows if row['last_refreshed_at']]
+    return max(stamps) if stamps else None
+
+
+def compact_number(value, prefix=''):
+    for threshold, suffix in ((1e12, 'T'), (1e9, 'B'), (1e6, 'M'), (1e3, 'K')):
+        if abs(value) >= threshold:
+            return f"{prefix}{value / threshold:.2f}{suffix}"
+    return f"{prefix}{value:,.0f}"
+
+
+def build_region_layouts(n=5):
+    """Top-n by GDP and by population as bar charts, one layout per region"""
+    rows = dataset_snapshot.get_rows()
+    counts = {}
+    for row in rows:
+        if row['region']:
+            counts[row['region']] = counts.get(row['region'], 0) + 1
+
+    layouts = {}
+    for region, count in sorted(counts.items()):
+        by_gdp = top_countries('estimated_gdp', n, region)
+        by_population = top_countries('population', n, region)
+        layout = SummaryLayout(800, 600)
+        layout.text(50, 30, f"{region} Summary", 'title', static=True)
+        layout.text(50, 80, f"Countries: {count}", 'heading')
+        y_position = layout.bar_chart(50, 130, 700, f"Top {n} by GDP", [
+            (country['name'], country['estimated_gdp'], compact_number(country['estimated_gdp'], '$'))
+            for country in by_gdp
+        ])
+        layout.bar_chart(50, y_position + 30, 700, f"Top {n} by Population", [
+            (country['name'], country['population'], compact_number(country['population']))
+            for country in by_population
+        ], fill='#3c9d6b')
+        refreshed_at = displayed_refresh_time(by_gdp + by_population)
+        if refreshed_at:
+            layout.text(50, 560, f"Last Refresh: {refreshed_at.strftime('%Y-%m-%d %H:%M:%S UTC')}", 'body')
+        layouts[region] = layout
+    return layouts
+
+
+def build_summary_layout():
+    """Lay out the summary image content; the raster and SVG renderers both draw it"""
     from .models import Country
     
     try:
-        # Get top 5 countries by GDP
-        top_countries = Country.objects.exclude(estimated_gdp__isnull=True)\
-                                     .order_by('-estimated_gdp')[:5]
+        # Get top 5 countries by GDP (shared with GET /countries/top)
+        top_five = top_countries('estimated_gdp', 5)
         
-        # Create image
-        img_width = 800
-        img_height = 600
-        image = Image.new('RGB', (img_width, img_height), color='white')
-        draw = ImageDraw.Draw(image)
-        
-        # Use default font
-        try:
-            font_large = ImageFont.truetype("arial.ttf", 24)
-            font_medium = ImageFont.truetype("arial.ttf", 18)
-            font_small = ImageFont.truetype("arial.ttf", 14)
-        except:
-            font_large = ImageFont.load_default()
-            font_medium = ImageFont.load_default()
-            font_small = ImageFont.load_default()
+        layout = SummaryLayout(800, 600)
         
         # Draw content
         y_position = 30
         
         # Title
-        draw.text((img_width//2 - 100, y_position), "Countries Summary", fill='black', font=font_large)
+        layout.text(800//2 - 100, y_position, "Countries Summary", 'title', static=True)
         y_position += 50
         
         # Total countries
         total_countries = Country.objects.count()
-        draw.text((50, y_position), f"Total Countries: {total_countries}", fill='black', font=font_medium)
+        layout.text(50, y_position, f"Total Countries: {total_countries}", 'heading')
         y_position += 40
         
         # Top countries by GDP
-        draw.text((50, y_position), "Top 5 Countries by GDP:", fill='black', font=font_medium)
+        layout.text(50, y_position, "Top 5 Countries by GDP:", 'heading', static=True)
         y_position += 40
         
-        for i, country in enumerate(top_countries, 1):
-            gdp_str = f"${country.estimated_gdp:,.2f}" if country.estimated_gdp else "N/A"
-            text = f"{i}. {country.name}: {gdp_str}"
-            draw.text((70, y_position), text, fill='black', font=font_small)
+        for i, country in enumerate(top_five, 1):
+            gdp_str = f"${country['estimated_gdp']:,.2f}" if country['estimated_gdp'] else "N/A"
+            layout.text(70, y_position, f"{i}. {country['name']}: {gdp_str}", 'body')
             y_position += 30
         
         y_position += 30
         
-        # Last refresh time
-        latest_country = Country.objects.order_by('-last_refreshed_at').first()
-        if latest_country:
-            refresh_time = latest_country.last_refreshed_at.strftime("%Y-%m-%d %H:%M:%S UTC")
-            draw.text((50, y_position), f"Last Refresh: {refresh_time}", fill='black', font=font_small)
-        
-        # Ensure cache directory exists
-        os.makedirs(settings.CACHE_DIR, exist_ok=True)
+        # Last refresh time of the rows shown, so it only moves when they change
+        refreshed_at = displayed_refresh_time(top_five)
+        if refreshed_at:
+            refresh_time = refreshed_at.strftime("%Y-%m-%d %H:%M:%S UTC")
+            layout.text(50, y_position, f"Last Refresh: {refresh_time}", 'body')
         
-        # Save image
-        image_path = os.path.join(settings.CACHE_DIR, 'summary.png')
-        image.save(image_path)
-        print(f"Image saved to: {image_path}")
-        
-        return image_path
+        return layout
     except Exception as e:
         print(f"Error generating image: {e}")
-        # Create a simple error image
-        try:
-            img = Image.new('RGB', (400, 200), color='red')
-            draw = ImageDraw.Draw(img)
-            draw.text((50, 80), "Error generating summary", fill='white')
-            error_path = os.path.join(settings.CACHE_DIR, 'summary.png')
-            img.save(error_path)
-            return error_path
-        except:
-            return None
+        return SummaryLayout.error("Error generating summary")
 
 
 
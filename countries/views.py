@@ -1,16 +1,46 @@
+import math
+
+import numpy as np
 from django.http import Http404, JsonResponse
 from rest_framework import status, filters
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from django_filters.rest_framework import DjangoFilterBackend
-from django.http import FileResponse
-import os
+from django.http import HttpResponse
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.http import parse_etags, quote_etag
+from django.urls import reverse
+from django.views.decorators.http import require_GET
+from django.db.models.functions import Lower
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from datetime import datetime, timedelta
 from django.conf import settings
 
 from .models import Country
 from .serializers import CountrySerializer
-from .utils import refresh_countries_data, generate_summary_image
+from .utils import (
+    refresh_countries_data, refresh_exchange_rates, RefreshInProgress,
+)
+from .images import (
+    DEFAULT_FORMAT, DEFAULT_SIZE, IMAGE_FORMATS, IMAGE_SIZES, image_set_file, region_slug,
+    summary_image_cache, variant_name,
+)
+from .metrics import render_prometheus
+from .rates import get_cross_rates, rate_history, HISTORY_INTERVALS
+from .sources import RefreshScope
+from .timing import timed
+from .services import (
+    get_dataset_version, bump_dataset_version, negative_lookup_cache,
+    get_country_stats, remove_country_from_stats, get_last_refreshed_at, top_countries, TOP_N_FIELDS, TOP_N_MAX,
+)
+
+# Sort keys that now live on the related Currency row
+SORT_FIELD_ALIASES = {
+    'currency_code': 'currency__code',
+    'exchange_rate': 'currency__rate',
+}
 
 class CountryListView(APIView):
     def get_queryset(self):
@@ -26,7 +56,7 @@ class CountryListView(APIView):
         if region:
             queryset = queryset.filter(region__iexact=region)
         if currency:
-            queryset = queryset.filter(currency_code__iexact=currency)
+            queryset = queryset.filter(currency__code__iexact=currency)
         
         # Apply sorting
         sort = request.GET.get('sort')
@@ -37,9 +67,9 @@ class CountryListView(APIView):
         elif sort and sort.endswith('_desc'):
             sort_field = sort.replace('_desc', '')
             if hasattr(Country, sort_field):
-                queryset = queryset.order_by(f'-{sort_field}')
+                queryset = queryset.order_by(f'-{SORT_FIELD_ALIASES.get(sort_field, sort_field)}')
         elif sort and hasattr(Country, sort):
-            queryset = queryset.order_by(sort)
+            queryset = queryset.order_by(SORT_FIELD_ALIASES.get(sort, sort))
         else:
             queryset = queryset.order_by('name')
         
@@ -52,8 +82,10 @@ class CountryListView(APIView):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        serializer = CountrySerializer(queryset, many=True)
-        return Response(serializer.data)
+        countries = list(queryset)
+        with timed('serialize'):
+            data = CountrySerializer(countries, many=True).data
+        return Response(data)
     
 class CountryDetailView(APIView):
     def get_object(self, name):
@@ -64,36 +96,107 @@ class CountryDetailView(APIView):
             raise Http404
     
     def get(self, request, name):
+        # Names that already missed for this dataset version skip the query
+        version = get_dataset_version()
+        if negative_lookup_cache.contains(name, version):
+            return Response({"error": "Country not found"}, status=status.HTTP_404_NOT_FOUND)
         try:
             country = self.get_object(name)
-            serializer = CountrySerializer(country)
-            return Response(serializer.data)
+            with timed('serialize'):
+                data = CountrySerializer(country).data
+            return Response(data)
         except Http404:
+            negative_lookup_cache.add(name, version)
             return Response({"error": "Country not found"}, status=status.HTTP_404_NOT_FOUND)
-    
-class CountryDeleteView(APIView):
-    def get_object(self, name):
-        try:
-            return Country.objects.get(name__iexact=name)
-        except Country.DoesNotExist:
-            raise Http404
 
     def delete(self, request, name):
         try:
             country = self.get_object(name)
+            previous_version = get_dataset_version()
             country.delete()
+            remove_country_from_stats(country, previous_version, bump_dataset_version())
             return Response(status=status.HTTP_204_NO_CONTENT)
         except Http404:
             return Response({"error": "Country not found"}, status=status.HTTP_404_NOT_FOUND)
         except Exception as e:
             return Response({"error": "Internal server error"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+
+class CountryBatchView(APIView):
+    """Resolve many country names with a single query"""
+    def get(self, request):
+        names = [n.strip() for n in request.GET.get('names', '').split(',') if n.strip()]
+        return self.lookup(names)
+
+    def post(self, request):
+        names = request.data.get('names') if isinstance(request.data, dict) else request.data
+        if not isinstance(names, list) or not all(isinstance(n, str) for n in names):
+            return Response(
+                {'error': 'Validation failed', 'details': {'names': 'must be a list of strings'}},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        return self.lookup([n.strip() for n in names if n.strip()])
+
+    def lookup(self, names):
+        if not names:
+            return Response(
+                {'error': 'Validation failed', 'details': {'names': 'is required'}},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        max_names = getattr(settings, 'BATCH_LOOKUP_MAX_NAMES', 100)
+        if len(names) > max_names:
+            return Response(
+                {'error': 'Validation failed', 'details': {'names': f'at most {max_names} names allowed'}},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        version = get_dataset_version()
+        wanted = {n.lower() for n in names if not negative_lookup_cache.contains(n, version)}
+        found = {}
+        if wanted:
+            queryset = Country.objects.annotate(name_lower=Lower('name')).filter(name_lower__in=wanted)
+            for country in queryset:
+                found[country.name_lower] = CountrySerializer(country).data
+
+        results = {}
+        not_found = []
+        for name in names:
+            data = found.get(name.lower())
+            if data is None:
+                negative_lookup_cache.add(name, version)
+                not_found.append(name)
+            results[name] = data
+        return Response({'results': results, 'not_found': not_found})
+
+SCOPE_FIELDS = ('regions', 'names', 'currencies', 'codes')
+
 @api_view(['POST'])
 def refresh_countries(request):
-    """Refresh countries data from external APIs"""
+    """Refresh countries data from external APIs, optionally scoped to a subset or as a dry run"""
+    data = request.data if isinstance(request.data, dict) else {}
+    invalid = {
+        field: 'must be a list of strings'
+        for field in SCOPE_FIELDS
+        if field in data and not (
+            isinstance(data[field], list) and all(isinstance(v, str) for v in data[field])
+        )
+    }
+    dry_run = data.get('dry_run', request.query_params.get('dry_run', False))
+    if isinstance(dry_run, str):
+        # Anything unrecognised is rejected, never taken as a real refresh
+        dry_run = {'1': True, 'true': True, 'yes': True,
+                   '0': False, 'false': False, 'no': False}.get(dry_run.strip().lower(), dry_run)
+    if not isinstance(dry_run, bool):
+        invalid['dry_run'] = 'must be a boolean'
+    if invalid:
+        return Response({'error': 'Validation failed', 'details': invalid}, status=status.HTTP_400_BAD_REQUEST)
+    scope = RefreshScope(**{field: data.get(field) for field in SCOPE_FIELDS})
+
     try:
-        result = refresh_countries_data()
+        result = refresh_countries_data(scope or None, dry_run=dry_run)
         return Response(result, status=status.HTTP_200_OK)
+    except RefreshInProgress as e:
+        return Response({'error': str(e)}, status=status.HTTP_409_CONFLICT)
     except Exception as e:
         print(f"Refresh error: {str(e)}")  # Add this line
         import traceback
@@ -112,14 +215,40 @@ def refresh_countries(request):
             status=status.HTTP_500_INTERNAL_SERVER_ERROR
         )
 
+@api_view(['POST'])
+def refresh_rates(request):
+    """Refresh exchange rates only and recompute estimated GDP"""
+    try:
+        return Response(refresh_exchange_rates(), status=status.HTTP_200_OK)
+    except RefreshInProgress as e:
+        return Response({'error': str(e)}, status=status.HTTP_409_CONFLICT)
+    except Exception as e:
+        print(f"Rates refresh error: {str(e)}")
+        if 'Exchange Rates API' in str(e):
+            return Response(
+                {
+                    'error': 'External data source unavailable',
+                    'details': str(e)
+                },
+                status=status.HTTP_503_SERVICE_UNAVAILABLE
+            )
+        return Response(
+            {'error': 'Internal server error'},
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR
+        )
+
 @api_view(['GET'])
 def status_view(request):
     """Get total countries and last refresh timestamp"""
     total_countries = Country.objects.count()
     
-    # Get latest refresh timestamp from any country
-    latest_country = Country.objects.order_by('-last_refreshed_at').first()
-    last_refreshed_at = latest_country.last_refreshed_at.isoformat() if latest_country else None
+    # Refreshes that change nothing leave rows untouched, so prefer the
+    # recorded completion time and fall back to the newest row
+    last_refreshed = get_last_refreshed_at()
+    if last_refreshed is None:
+        latest_country = Country.objects.order_by('-last_refreshed_at').first()
+        last_refreshed = latest_country.last_refreshed_at if latest_country else None
+    last_refreshed_at = last_refreshed.isoformat() if last_refreshed else None
     
     return Response({
         'total_countries': total_countries,
@@ -127,72 +256,374 @@ def status_view(request):
     })
 
 
+@api_view(['GET'])
+def country_stats(request):
+    """Get per-region and per-currency aggregates"""
+    return Response(get_country_stats())
+
 
 @api_view(['GET'])
-def countries_image(request):
-    """Serve the generated summary image"""
+def country_top(request):
+    """Get the top-N countries by a numeric field"""
+    by = request.GET.get('by', 'estimated_gdp')
+    if by not in TOP_N_FIELDS:
+        return Response(
+            {'error': 'Validation failed', 'details': {'by': f"must be one of {', '.join(TOP_N_FIELDS)}"}},
+            status=status.HTTP_400_BAD_REQUEST
+        )
     try:
-        image_path = os.path.join(settings.CACHE_DIR, 'summary.png')
-        
-        if not os.path.exists(image_path):
-            # Generate image if it doesn't exist
-            print("Image not found, generating...")
-            generate_summary_image()
-        
-        if os.path.exists(image_path):
-            return FileResponse(open(image_path, 'rb'), content_type='image/png')
-        else:
-            return Response(
-                {'error': 'Summary image not available'},
-                status=status.HTTP_404_NOT_FOUND
-            )
-    except Exception as e:
-        print(f"Error serving image: {e}")
+        n = int(request.GET.get('n', 10))
+    except ValueError:
+        n = 0
+    if not 1 <= n <= TOP_N_MAX:
         return Response(
-            {'error': 'Failed to generate or serve image'},
-            status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            {'error': 'Validation failed', 'details': {'n': f'must be an integer between 1 and {TOP_N_MAX}'}},
+            status=status.HTTP_400_BAD_REQUEST
         )
-    
-    
-@api_view(['GET'])     
-def get_country_images(request):
+    return Response(top_countries(by, n, request.GET.get('region')))
+
+
+def _rates_unavailable():
+    return Response(
+        {'error': 'Exchange rates not available'},
+        status=status.HTTP_503_SERVICE_UNAVAILABLE
+    )
+
+
+def _is_finite_number(value):
+    # bool is an int subclass; strings and nested lists are not amounts
+    if not isinstance(value, (int, float)) or isinstance(value, bool):
+        return False
     try:
-        image_path = os.path.join(settings.CACHE_DIR, 'summary.png')
-        
-        if not os.path.exists(image_path):
-            # Generate image if it doesn't exist
-            print("Image not found, generating...")
-            generate_summary_image()
-        
-        if os.path.exists(image_path):
-            return FileResponse(open(image_path, 'rb'), content_type='image/png')
-        else:
+        return math.isfinite(value)
+    except OverflowError:
+        return False
+
+
+def _result_out_of_range():
+    return Response(
+        {'error': 'Validation failed', 'details': {'amount': 'converted amount is out of range'}},
+        status=status.HTTP_400_BAD_REQUEST
+    )
+
+
+@api_view(['GET'])
+def rates_view(request):
+    """Get all exchange rates against a base currency (USD by default)"""
+    matrix = get_cross_rates()
+    if matrix is None:
+        return _rates_unavailable()
+    base = request.GET.get('base', matrix.base).upper()
+    try:
+        rates = matrix.rates_from(base)
+    except KeyError:
+        return Response(
+            {'error': 'Validation failed', 'details': {'base': f'Unknown currency: {base}'}},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    return Response({
+        'base': base,
+        'fetched_at': matrix.fetched_at,
+        'rates': rates,
+    })
+
+
+@api_view(['GET', 'POST'])
+def convert_view(request):
+    """Convert one amount (GET) or many amounts in bulk (POST)"""
+    matrix = get_cross_rates()
+    if matrix is None:
+        return _rates_unavailable()
+
+    if request.method == 'GET':
+        source = request.GET.get('from', '')
+        target = request.GET.get('to', '')
+        try:
+            amount = float(request.GET.get('amount', 1))
+        except ValueError:
+            amount = math.nan
+        if not math.isfinite(amount):
             return Response(
-                {'error': 'Summary image not available'},
-                status=status.HTTP_404_NOT_FOUND
+                {'error': 'Validation failed', 'details': {'amount': 'must be a number'}},
+                status=status.HTTP_400_BAD_REQUEST
             )
-    except Exception as e:
-        print(f"Error serving image: {e}")
+        try:
+            rate = matrix.rate(source, target)
+        except KeyError as e:
+            return Response(
+                {'error': 'Validation failed', 'details': {'currency': f'Unknown currency: {e.args[0]}'}},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if not math.isfinite(amount * rate):
+            return _result_out_of_range()
+        return Response({
+            'from': source.upper(),
+            'to': target.upper(),
+            'amount': amount,
+            'rate': rate,
+            'result': amount * rate,
+        })
+
+    data = request.data if isinstance(request.data, dict) else {}
+    source = data.get('from')
+    target = data.get('to')
+    amounts = data.get('amounts')
+    max_amounts = getattr(settings, 'CONVERT_BULK_MAX_AMOUNTS', 10000)
+    details = {}
+    if not isinstance(amounts, list) or not amounts or not all(_is_finite_number(a) for a in amounts) \
+            or np.asarray(amounts).ndim != 1:
+        details['amounts'] = 'must be a non-empty list of numbers'
+    elif len(amounts) > max_amounts:
+        details['amounts'] = f'at most {max_amounts} amounts allowed'
+    for field, value in (('from', source), ('to', target)):
+        if isinstance(value, list):
+            if isinstance(amounts, list) and len(value) != len(amounts):
+                details[field] = 'must have the same length as amounts'
+        elif not isinstance(value, str):
+            details[field] = 'must be a currency code or a list of codes'
+    if details:
         return Response(
-            {'error': 'Failed to generate or serve image'},
-            status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            {'error': 'Validation failed', 'details': details},
+            status=status.HTTP_400_BAD_REQUEST
         )
-@api_view(['GET'])
-def get_country_image(request):
 
-    """Serve the generated summary image"""
-    image_path = os.path.join(settings.CACHE_DIR, 'summary.png')
-    
-    if not os.path.exists(image_path):
+    try:
+        with np.errstate(over='ignore'):
+            results = matrix.convert(source, target, amounts)
+    except KeyError as e:
         return Response(
-            {'error': 'Summary image not found'},
-            status=status.HTTP_404_NOT_FOUND
+            {'error': 'Validation failed', 'details': {'currency': f'Unknown currency: {e.args[0]}'}},
+            status=status.HTTP_400_BAD_REQUEST
         )
-    
-    try:
-        return FileResponse(open(image_path, 'rb'), content_type='image/png')
-    except FileNotFoundError:
+    except (TypeError, ValueError, AttributeError):
+        return Response(
+            {'error': 'Validation failed', 'details': {'amounts': 'must be a non-empty list of numbers'}},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    if not np.isfinite(results).all():
+        return _result_out_of_range()
+    return Response({
+        'from': source,
+        'to': target,
+        'results': results.tolist(),
+    })
+
+
+def _parse_history_bound(value):
+    """Parse an ISO date or datetime query value into an aware datetime"""
+    parsed = parse_datetime(value)
+    if parsed is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValueError(value)
+        parsed = datetime(day.year, day.month, day.day)
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+@api_view(['GET'])
+def rate_history_view(request):
+    """Get downsampled exchange rate history for one currency"""
+    currency = request.GET.get('currency', '').strip()
+    interval_name = request.GET.get('interval', 'day')
+    details = {}
+    if not currency:
+        details['currency'] = 'is required'
+    if interval_name not in HISTORY_INTERVALS:
+        details['interval'] = f"must be one of {', '.join(HISTORY_INTERVALS)}"
+
+    end = timezone.now()
+    start = end - timedelta(days=30)
+    for field in ('from', 'to'):
+        value = request.GET.get(field)
+        if not value:
+            continue
+        try:
+            bound = _parse_history_bound(value)
+        except ValueError:
+            details[field] = 'must be an ISO 8601 date or datetime'
+            continue
+        if field == 'from':
+            start = bound
+        else:
+            end = bound
+    if details:
+        return Response({'error': 'Validation failed', 'details': details}, status=status.HTTP_400_BAD_REQUEST)
+
+    interval = HISTORY_INTERVALS[interval_name]
+    max_points = getattr(settings, 'RATE_HISTORY_MAX_POINTS', 5000)
+    if (end - start).total_seconds() / interval > max_points:
         return Response(
-            {'error': 'Summary image not found'},
+            {'error': 'Validation failed', 'details': {'interval': f'range would exceed {max_points} points, use a larger interval'}},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+
+    return Response({
+        'currency': currency.upper(),
+        'base': 'USD',
+        'interval': interval_name,
+        'from': start.isoformat(),
+        'to': end.isoformat(),
+        'points': rate_history(currency, start, end, interval),
+    })
+
+
+
+# Digest-addressed image URLs never change content, so caches may keep them for a year
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+# Seconds a client should wait when no image set has been rendered yet
+COLD_START_RETRY_AFTER = 30
+
+
+def accepted_types(header):
+    """Media types in an Accept header, skipping any with q=0"""
+    types = set()
+    for part in header.split(','):
+        media_type, *params = [p.strip() for p in part.split(';')]
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            types.add(media_type.lower())
+    return types
+
+
+def summary_image_response(request):
+    """Serve a summary image variant from memory
+
+    ?size= picks thumb, 1x or 2x and ?format= picks png, webp, avif or svg; without
+    ?format= the best format named in the Accept header wins. ?region= selects
+    that region's chart image instead of the global summary. A stale image is
+    served as-is while a refresh re-renders it; before the first image set is
+    published the answer is 503 with Retry-After, since rendering here would
+    tie up a worker. Content-Location names the immutable URL of the variant
+    that was served.
+
+    These are plain Django views: DRF would reject image Accept headers and
+    treat ?format= as its renderer override.
+    """
+    size = request.GET.get('size', DEFAULT_SIZE)
+    fmt = request.GET.get('format')
+    region = request.GET.get('region')
+    region = region_slug(region) if region else None
+    errors = {}
+    if size not in IMAGE_SIZES:
+        errors['size'] = f"must be one of: {', '.join(IMAGE_SIZES)}"
+    if fmt is not None and fmt not in IMAGE_FORMATS:
+        errors['format'] = f"must be one of: {', '.join(IMAGE_FORMATS)}"
+    if errors:
+        return JsonResponse({'error': 'Validation failed', 'details': errors}, status=status.HTTP_400_BAD_REQUEST)
+
+    if fmt:
+        candidates = [fmt]
+    else:
+        accepted = accepted_types(request.headers.get('Accept', ''))
+        candidates = [f for f, (content_type, _) in IMAGE_FORMATS.items() if content_type in accepted]
+        candidates.append(DEFAULT_FORMAT)
+
+    names = [variant_name(size, candidate, region) for candidate in candidates]
+    digest, name = summary_image_cache.locate(names)
+    if digest is None:
+        # Rendering belongs to refreshes and the scheduler, never to a request
+        response = JsonResponse(
+            {'error': 'Summary image is being generated, try again shortly'},
+            status=status.HTTP_503_SERVICE_UNAVAILABLE
+        )
+        response['Retry-After'] = str(COLD_START_RETRY_AFTER)
+        return response
+
+    if name is None:
+        return JsonResponse(
+            {'error': 'Region summary image not found' if region else 'Summary image not available'},
             status=status.HTTP_404_NOT_FOUND
-        )
\ No newline at end of file
+        )
+    response = image_file_response(request, digest, name)
+    if response is None:
+        return JsonResponse({'error': 'Summary image not available'}, status=status.HTTP_404_NOT_FOUND)
+    patch_cache_control(response, public=True, max_age=getattr(settings, 'SUMMARY_IMAGE_MAX_AGE', 0))
+    response['Content-Location'] = reverse('countries-image-file', args=[digest, name])
+    if not fmt:
+        patch_vary_headers(response, ['Accept'])
+    return response
+
+
+def image_file_response(request, digest, name):
+    """Response for one stored variant, or None if it is gone
+
+    With IMAGE_SENDFILE_BACKEND set to 'nginx' or 'sendfile' the body is left
+    to the front proxy via X-Accel-Redirect or X-Sendfile; otherwise it comes
+    from the per-worker memory cache, or from disk for an older image set.
+    """
+    content_type = IMAGE_FORMATS[name.rsplit('.', 1)[-1]][0]
+    etag = quote_etag(f'{digest}/{name}')
+    backend = getattr(settings, 'IMAGE_SENDFILE_BACKEND', None)
+    if etag in parse_etags(request.headers.get('If-None-Match', '')):
+        response = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+    elif backend == 'nginx':
+        response = HttpResponse(content_type=content_type)
+        prefix = getattr(settings, 'IMAGE_SENDFILE_PREFIX', '/protected-images/')
+        response['X-Accel-Redirect'] = f"{prefix.rstrip('/')}/{digest}/{name}"
+    elif backend == 'sendfile':
+        path = image_set_file(digest, name)
+        if path is None:
+            return None
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = path
+    else:
+        body = summary_image_cache.read(digest, name)
+        if body is None:
+            path = image_set_file(digest, name)
+            if path is None:
+                return None
+            try:
+                with open(path, 'rb') as f:
+                    body = f.read()
+            except FileNotFoundError:
+                return None
+        response = HttpResponse(body, content_type=content_type)
+    response['ETag'] = etag
+    return response
+
+
+@require_GET
+def countries_image_file(request, digest, name):
+    """Serve a variant by its content digest; the URL never changes meaning, so it is immutable"""
+    if image_set_file(digest, name) is None:
+        return JsonResponse({'error': 'Image not found'}, status=status.HTTP_404_NOT_FOUND)
+    response = image_file_response(request, digest, name)
+    if response is None:
+        return JsonResponse({'error': 'Image not found'}, status=status.HTTP_404_NOT_FOUND)
+    patch_cache_control(response, public=True, max_age=IMMUTABLE_MAX_AGE, immutable=True)
+    return response
+
+
+@require_GET
+def countries_image(request):
+    """Serve the generated summary image"""
+    return summary_image_response(request)
+
+
+@require_GET
+def get_country_images(request):
+    return summary_image_response(request)
+
+
+@require_GET
+def get_country_image(request):
+    """Serve the generated summary image"""
+    return summary_image_response(request)
+
+
+@require_GET
+def metrics_view(request):
+    """Prometheus metrics summed across all worker processes"""
+    if not getattr(settings, 'METRICS_ENABLED', True):
+        return JsonResponse({'error': 'Endpoint not found'}, status=status.HTTP_404_NOT_FOUND)
+    return HttpResponse(render_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
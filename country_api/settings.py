@@ -60,6 +60,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'countries.middleware.RequestTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -169,7 +170,7 @@ if DEBUG:
 
 REST_FRAMEWORK = {
     'DEFAULT_RENDERER_CLASSES': [
-        'rest_framework.renderers.JSONRenderer',
+        'countries.timing.TimedJSONRenderer',
     ],
     'DEFAULT_PARSER_CLASSES': [
         'rest_framework.parsers.JSONParser',
@@ -205,6 +206,89 @@ os.makedirs(CACHE_DIR, exist_ok=True)
 APPEND_SLASH = False
 
 
+# Max number of unknown country names remembered per worker for fast 404s
+NEGATIVE_LOOKUP_CACHE_SIZE = int(os.getenv('NEGATIVE_LOOKUP_CACHE_SIZE', '10000'))
+
+# Max number of names accepted by the batch lookup endpoint
+BATCH_LOOKUP_MAX_NAMES = int(os.getenv('BATCH_LOOKUP_MAX_NAMES', '100'))
+
+# Max number of amounts accepted by a bulk POST /convert
+CONVERT_BULK_MAX_AMOUNTS = int(os.getenv('CONVERT_BULK_MAX_AMOUNTS', '10000'))
+
+# Seconds after which a crashed refresh releases its lock
+REFRESH_LOCK_TIMEOUT = int(os.getenv('REFRESH_LOCK_TIMEOUT', '600'))
+
+# Max number of buckets returned by GET /rates/history
+RATE_HISTORY_MAX_POINTS = int(os.getenv('RATE_HISTORY_MAX_POINTS', '5000'))
+
+# 'random' draws a new GDP multiplier per refresh; 'stable' derives it from
+# the country name and seed so unchanged inputs give unchanged GDP
+GDP_MULTIPLIER_MODE = os.getenv('GDP_MULTIPLIER_MODE', 'random')
+GDP_MULTIPLIER_SEED = os.getenv('GDP_MULTIPLIER_SEED', 'country-api')
+
+# Upstream data adapters, configured like CACHES. Point LOCATION at a mirror
+# or at `manage.py fixture_server` to refresh offline, or use the File*
+# backends with a path to a recorded payload.
+COUNTRY_DATA_SOURCES = {
+    'countries': {
+        'BACKEND': os.getenv('COUNTRIES_SOURCE_BACKEND', 'countries.sources.RestCountriesSource'),
+        'LOCATION': os.getenv('COUNTRIES_SOURCE_LOCATION', 'https://restcountries.com/v2'),
+        'OPTIONS': {'timeout': 30},
+    },
+    'rates': {
+        'BACKEND': os.getenv('RATES_SOURCE_BACKEND', 'countries.sources.OpenErApiRatesSource'),
+        'LOCATION': os.getenv('RATES_SOURCE_LOCATION', 'https://open.er-api.com/v6'),
+        'OPTIONS': {'timeout': 30},
+    },
+}
+
+# Countries parsed and written per bulk INSERT while streaming a refresh
+REFRESH_BATCH_SIZE = int(os.getenv('REFRESH_BATCH_SIZE', '100'))
+# Upstream records buffered by a background fetch thread (0 fetches inline)
+REFRESH_PREFETCH = int(os.getenv('REFRESH_PREFETCH', '500'))
+
+# manage.py run_scheduler: refresh intervals in seconds, +/- jitter fraction,
+# leader lease lifetime and the cap on exponential backoff after failures.
+# Refreshes publish through CACHES and CACHE_DIR, which are local files here, so
+# the scheduler runs inside the web container (see Procfile), not on its own dyno.
+COUNTRIES_REFRESH_INTERVAL = float(os.getenv('COUNTRIES_REFRESH_INTERVAL', '86400'))
+RATES_REFRESH_INTERVAL = float(os.getenv('RATES_REFRESH_INTERVAL', '3600'))
+SCHEDULER_JITTER = float(os.getenv('SCHEDULER_JITTER', '0.1'))
+SCHEDULER_LEASE_TTL = float(os.getenv('SCHEDULER_LEASE_TTL', '300'))
+SCHEDULER_MAX_BACKOFF = float(os.getenv('SCHEDULER_MAX_BACKOFF', '3600'))
+
+# Browser cache lifetime for GET /countries/image; clients revalidate with the ETag after it
+SUMMARY_IMAGE_MAX_AGE = int(os.getenv('SUMMARY_IMAGE_MAX_AGE', '0'))
+# Seconds a worker trusts its in-memory copy of the published image digest before re-reading the cache
+SUMMARY_IMAGE_CHECK_INTERVAL = float(os.getenv('SUMMARY_IMAGE_CHECK_INTERVAL', '2'))
+# Processes used to rasterize and encode the global and per-region images after a refresh
+# run by the scheduler or a management command. The pool lives as long as that process, so
+# each worker's font and template cache carries over between refreshes; 1 renders in process.
+# Refreshes triggered through the API always render inside the web worker
+IMAGE_RENDER_WORKERS = int(os.getenv('IMAGE_RENDER_WORKERS', str(min(4, os.cpu_count() or 1))))
+# TrueType font for raster images; unset uses the font embedded in Pillow
+SUMMARY_FONT_PATH = os.getenv('SUMMARY_FONT_PATH') or None
+# Let the front proxy stream image files: 'nginx' (X-Accel-Redirect to IMAGE_SENDFILE_PREFIX,
+# mapped to CACHE_DIR/images) or 'sendfile' (X-Sendfile with the absolute path); unset serves from memory
+IMAGE_SENDFILE_BACKEND = os.getenv('IMAGE_SENDFILE_BACKEND') or None
+IMAGE_SENDFILE_PREFIX = os.getenv('IMAGE_SENDFILE_PREFIX', '/protected-images/')
+
+# Send per-request total/db/cache/serialize timings to clients as a Server-Timing header.
+# Off by default: the breakdown tells anyone how many queries and how much DB time an
+# endpoint costs. The same numbers always go to /metrics and, for slow requests, the log
+SERVER_TIMING_HEADER = os.getenv('SERVER_TIMING_HEADER', 'false').lower() == 'true'
+# Requests slower than this many milliseconds are logged with their timing breakdown
+SLOW_REQUEST_MS = float(os.getenv('SLOW_REQUEST_MS', '1000'))
+
+# Prometheus metrics at /metrics; each process writes its samples to a file in METRICS_DIR
+# at most every METRICS_FLUSH_INTERVAL seconds and a scrape sums them. The directory must be
+# shared by all gunicorn workers and the scheduler on one host; a scrape folds the files of
+# exited processes into metrics-total.json. Empty it on deploy to reset counters.
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
+METRICS_DIR = os.getenv('METRICS_DIR') or os.path.join(CACHE_DIR, 'metrics')
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', '1.0'))
+
+
 CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
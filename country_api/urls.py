@@ -1,7 +1,7 @@
 from django.contrib import admin
 from django.urls import path, include
 from django.conf.urls import handler404, handler500, handler400
-from countries.views import status_view
+from countries.views import status_view, rates_view, convert_view, refresh_rates, rate_history_view, metrics_view
 from django.http import JsonResponse
 
 
@@ -10,12 +10,21 @@ def api_root(request):
         "message": "Country Currency & Exchange API",
         "version": "1.0",
         "endpoints": {
-            "refresh_countries": "POST /countries/refresh/",
+            "refresh_countries": "POST /countries/refresh/ {regions, names, currencies, codes, dry_run}",
             "list_countries": "GET /countries/",
             "get_country": "GET /countries/{name}/",
+            "batch_countries": "GET /countries/batch?names=a,b,c | POST /countries/batch",
             "delete_country": "DELETE /countries/{name}/",
             "status": "GET /countries/status/",
-            "summary_image": "GET /countries/image/",
+            "stats": "GET /countries/stats",
+            "top_countries": "GET /countries/top?by=estimated_gdp|population|exchange_rate&n=&region=",
+            "summary_image": "GET /countries/image/?size=thumb|1x|2x&format=png|webp|avif|svg&region=",
+            "summary_image_file": "GET /countries/image/{digest}/{file} (immutable, see Content-Location)",
+            "rates": "GET /rates?base=USD",
+            "refresh_rates": "POST /rates/refresh",
+            "rate_history": "GET /rates/history?currency=&from=&to=&interval=minute|hour|day|week",
+            "convert": "GET /convert?from=&to=&amount= | POST /convert",
+            "metrics": "GET /metrics (Prometheus text format)",
             "admin": "/admin/"
         },
         "documentation": "Check README for usage instructions"
@@ -29,4 +38,9 @@ urlpatterns = [
     path('admin/', admin.site.urls),
     path('countries/', include('countries.urls')),
     path('status/', status_view, name='status'),
+    path('rates', rates_view, name='rates'),
+    path('rates/refresh', refresh_rates, name='refresh-rates'),
+    path('rates/history', rate_history_view, name='rate-history'),
+    path('convert', convert_view, name='convert'),
+    path('metrics', metrics_view, name='metrics'),
 ] 
\ No newline at end of file